@@ -30,10 +30,14 @@ setup(
         'Flask-Mako',
         'lxml',
     ],
+    extras_require={
+        'thumbnails': ['Pillow'],
+    },
     entry_points="""
     [console_scripts]
     flask-ctl = presence_analyzer.script:run
     update = presence_analyzer.script:make_update
+    compact = presence_analyzer.script:make_compact
 
     [paste.app_factory]
     main = presence_analyzer.script:make_app
@@ -1,4 +1,7 @@
 # -*- coding: utf-8 -*-
-"""Initialize the package"""
-from .main import app
-from . import views
+"""Initialize the package.
+
+Application lives in presence_analyzer.main and its views are registered
+by presence_analyzer.script.make_app, so command line tools importing
+this package don't load the web stack.
+"""
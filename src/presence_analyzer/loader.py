@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""Background loading of presence data.
+
+DataLoader polls modification times of DATA_CSV, DATA_XML and ROLLUP_CSV,
+rebuilds data and derived indexes when they change and publishes them as
+a new Snapshot, so requests only read already loaded data. Histograms of
+the new data are built right after publishing.
+
+Presence data and its weekday aggregates are kept in the snapshot only
+for 'memory' storage. Other backends get their own database or index
+rebuilt instead, and snapshot's 'data' and 'weekdays' are None.
+"""
+
+import os
+import threading
+from collections import namedtuple
+from datetime import datetime
+
+from presence_analyzer.main import app
+from presence_analyzer import storage
+from presence_analyzer.rollup import (
+    read_rollup,
+    rollup_source,
+)
+from presence_analyzer.utils import (
+    SNAPSHOT,
+    get_histograms,
+    parse_data,
+    parse_users_data,
+)
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+Snapshot = namedtuple(  # pylint: disable-msg=C0103
+    'Snapshot',
+    [
+        'generation',
+        'sources',
+        'loaded_at',
+        'data',
+        'users',
+        'weekdays',
+        'rollup',
+    ],
+)
+
+
+class DataLoader(threading.Thread):
+    """Thread reloading data every 'interval' seconds if sources changed."""
+
+    def __init__(self, interval):
+        super(DataLoader, self).__init__(name='presence-loader')
+        self.daemon = True
+        self.interval = interval
+        self.generation = 0
+        self.published = threading.Event()
+        # set after first load, whether it succeeded or not
+        self.attempted = threading.Event()
+        self.waited = False
+        self.stopped = threading.Event()
+
+    @staticmethod
+    def sources():
+        """Returns (path, mtime) of each source file. Roll-up file is
+        optional, its mtime is None when there's no such file.
+        """
+        return tuple(
+            (path, os.path.getmtime(path))
+            for path in (app.config['DATA_CSV'], app.config['DATA_XML'])
+        ) + (rollup_source(),)
+
+    def reload(self, sources):
+        """Builds and publishes a new snapshot of given sources."""
+        (csv_path, _), (xml_path, _), (rollup_path, _) = sources
+        backend = app.config.get('STORAGE', 'memory')
+        rollup = read_rollup(rollup_path)
+        data = weekdays = None
+        if backend == 'sqlite':
+            storage.import_csv(sources[0])
+        elif backend == 'lazy':
+            storage.build_lazy_index(sources[0])
+        else:
+            data = parse_data(csv_path)
+            weekdays = {
+                user_id: storage.aggregate_weekdays(items, rollup[0])
+                for user_id, items in data.iteritems()
+            }
+        snapshot = Snapshot(
+            generation=self.generation + 1,
+            sources=sources,
+            loaded_at=datetime.now(),
+            data=data,
+            users=parse_users_data(xml_path),
+            weekdays=weekdays,
+            rollup=rollup,
+        )
+
+        self.generation = snapshot.generation
+        SNAPSHOT['current'] = snapshot
+        self.published.set()
+        log.info('Published data generation %d', snapshot.generation)
+        if data is not None:
+            get_histograms()
+        return snapshot
+
+    def run(self):
+        """Reloads data until stopped."""
+        sources = None
+        while not self.stopped.is_set():
+            try:
+                current = self.sources()
+                if current != sources:
+                    self.reload(current)
+                    sources = current
+            except Exception:  # pylint: disable-msg=W0703
+                log.exception('Loading data failed')
+            self.attempted.set()
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        """Stops the thread and waits for it."""
+        self.stopped.set()
+        self.join()
+
+
+def start_loader():
+    """Starts background loader unless 'LOADER_INTERVAL' is not set or it's
+    already running.
+    """
+    interval = app.config.get('LOADER_INTERVAL')
+    if not interval:
+        return None
+    if SNAPSHOT['loader'] is None:
+        loader = DataLoader(interval)
+        SNAPSHOT['loader'] = loader
+        loader.start()
+    return SNAPSHOT['loader']
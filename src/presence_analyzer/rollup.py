@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""Roll-up of old presence data.
+
+Compaction moves rows of DATA_CSV older than 'ROLLUP_MONTHS' full months
+into per user, per month, per weekday aggregates kept in 'ROLLUP_CSV'.
+Its first line holds the cutoff date, others look like:
+    user_id,YYYY-MM,weekday,count,presence,start,end
+where 'presence', 'start' and 'end' are sums in seconds.
+"""
+
+import os
+import csv
+from datetime import (
+    date,
+    datetime,
+)
+
+from presence_analyzer.main import app
+from presence_analyzer.utils import (
+    csv_row,
+    get_snapshot,
+    iter_presence_rows,
+    locker,
+    seconds_since_midnight,
+)
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+FIELDS = ('count', 'presence', 'start', 'end')
+
+# roll-up loaded on demand and its source (path, mtime)
+LOADED = {'source': None, 'rollup': (None, {})}
+
+
+def rollup_cutoff(today, months):
+    """Returns first day of the month 'months' months before given date."""
+    month = today.year * 12 + today.month - 1 - months
+    return date(month // 12, month % 12 + 1, 1)
+
+
+def parse_rollup(path):
+    """Reads roll-up file. Returns its cutoff date and aggregates keyed by
+    (user_id, 'YYYY-MM', weekday). Missing file gives (None, {}).
+    """
+    if not path or not os.path.exists(path):
+        return None, {}
+    months = {}
+    with open(path, 'r') as csvfile:
+        reader = csv.reader(csvfile, delimiter=',')
+        cutoff = datetime.strptime(next(reader)[1], '%Y-%m-%d').date()
+        for row in reader:
+            key = (int(row[0]), row[1], int(row[2]))
+            months[key] = [int(value) for value in row[3:]]
+    return cutoff, months
+
+
+def write_rollup(path, cutoff, months):
+    """Writes roll-up file."""
+    with open(path, 'w') as csvfile:
+        csvfile.write('cutoff,{0}\n'.format(cutoff.isoformat()))
+        for key in sorted(months):
+            csvfile.write(','.join(
+                str(value) for value in key + tuple(months[key])
+            ) + '\n')
+
+
+def compact(csv_path, rollup_path, cutoff):
+    """Rolls rows of presence CSV older than cutoff into roll-up file and
+    leaves only newer rows in the CSV. Malformed rows are dropped.
+
+    Rows older than cutoff of an earlier compaction are already rolled
+    up, so running it again after a failure doesn't count them twice.
+    Returns number of rolled up rows.
+    """
+    previous, months = parse_rollup(rollup_path)
+    if previous is not None and previous > cutoff:
+        cutoff = previous
+    rolled = 0
+    tmp_csv_path = '{0}.{1}.tmp'.format(csv_path, os.getpid())
+    with open(tmp_csv_path, 'w') as csvfile:
+        for row in iter_presence_rows(csv_path):
+            user_id, day, start, end = row
+            if day >= cutoff:
+                csvfile.write(csv_row(row))
+                continue
+            if previous is not None and day < previous:
+                continue
+            start = seconds_since_midnight(start)
+            end = seconds_since_midnight(end)
+            key = (user_id, day.strftime('%Y-%m'), day.weekday())
+            totals = months.setdefault(key, [0, 0, 0, 0])
+            for i, value in enumerate((1, end - start, start, end)):
+                totals[i] += value
+            rolled += 1
+
+    tmp_rollup_path = '{0}.{1}.tmp'.format(rollup_path, os.getpid())
+    write_rollup(tmp_rollup_path, cutoff, months)
+    os.rename(tmp_rollup_path, rollup_path)
+    os.rename(tmp_csv_path, csv_path)
+    log.info('Rolled up %d rows older than %s', rolled, cutoff)
+    return rolled
+
+
+def read_rollup(path):
+    """Returns cutoff date of roll-up and its aggregates of each user by
+    weekday. Rows dated before the cutoff are already rolled up and must
+    be left out of raw data.
+
+    It creates structure like this:
+    rollup = (datetime.date(2013, 1, 1), {
+        10: {
+            0: {'count': 40, 'presence': 1152000, 'start': ..., 'end': ...},
+            ...
+        },
+    })
+    with weekdays without rolled up entries left out. Missing file gives
+    (None, {}).
+    """
+    cutoff, months = parse_rollup(path)
+    result = {}
+    for (user_id, _, weekday), totals in months.iteritems():
+        stats = result.setdefault(user_id, {}).setdefault(
+            weekday, dict.fromkeys(FIELDS, 0)
+        )
+        for name, value in zip(FIELDS, totals):
+            stats[name] += value
+    return cutoff, result
+
+
+def rollup_source():
+    """Returns (path, mtime) of current ROLLUP_CSV. Its mtime is None when
+    there's no such file.
+    """
+    path = app.config.get('ROLLUP_CSV')
+    if path and os.path.exists(path):
+        return path, os.path.getmtime(path)
+    return path, None
+
+
+def get_rollup():
+    """Returns roll-up cutoff and aggregates of current snapshot or loaded
+    on demand from 'ROLLUP_CSV'.
+    """
+    snapshot = get_snapshot()
+    if snapshot is not None:
+        return snapshot.rollup
+    source = rollup_source()
+    if LOADED['source'] != source:
+        load_rollup(source)
+    return LOADED['rollup']
+
+
+@locker
+def load_rollup(source):
+    """Loads roll-up aggregates of given source on demand, unless they are
+    loaded already.
+    """
+    if LOADED['source'] != source:
+        LOADED['rollup'] = read_rollup(source[0])
+        LOADED['source'] = source
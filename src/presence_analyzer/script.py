@@ -6,9 +6,6 @@ import os
 import sys
 from functools import partial
 
-import paste.script.command
-import werkzeug.script
-
 etc = partial(os.path.join, 'parts', 'etc')
 
 DEPLOY_INI = etc('deploy.ini')
@@ -27,9 +24,19 @@ del _buildout_path
 
 # bin/paster serve parts/etc/deploy.ini
 def make_app(global_conf={}, config=DEPLOY_CFG, debug=False):
-    from presence_analyzer import app
+    from presence_analyzer.main import app
+    from presence_analyzer import views  # registers routes
+    from presence_analyzer.loader import start_loader
+    from presence_analyzer.views import TEMPLATE_LIST
+    from presence_analyzer.warmup import start_warm_up
     app.config.from_pyfile(abspath(config))
     app.debug = debug
+    start_loader()
+    if app.config.get('WARMUP'):
+        start_warm_up(TEMPLATE_LIST)
+    if app.config.get('AVATAR_DIR'):
+        from presence_analyzer.utils import start_avatar_refresh
+        start_avatar_refresh()
     return app
 
 
@@ -50,13 +57,36 @@ def make_shell():
     return locals()
 
 
+def read_config(config):
+    """Read configuration file without importing Flask."""
+    values = {'__file__': abspath(config)}
+    execfile(abspath(config), values)
+    return values
+
+
 # bin/flask-ctl update
 def make_update(dry_run=False):
-    """Update server data."""
-    from presence_analyzer.main import app
-    from presence_analyzer.utils import update_xml
-    app.config.from_pyfile(abspath(DEPLOY_CFG))
-    return update_xml()
+    """Update server data and stored avatars."""
+    from presence_analyzer.update import (
+        download_xml,
+        parse_users_data,
+        store_avatars,
+    )
+    config = read_config(DEPLOY_CFG)
+    result = download_xml(config['DATA_SERVER_ADDRESS'], config['DATA_XML'])
+    if config.get('AVATAR_DIR'):
+        store_avatars(parse_users_data(config['DATA_XML']), config)
+    return result
+
+
+# bin/compact
+def make_compact(dry_run=False):
+    """Roll up presence data older than ROLLUP_MONTHS."""
+    from datetime import date
+    from presence_analyzer.rollup import compact, rollup_cutoff
+    config = read_config(DEPLOY_CFG)
+    cutoff = rollup_cutoff(date.today(), config.get('ROLLUP_MONTHS', 12))
+    return compact(config['DATA_CSV'], config['ROLLUP_CSV'], cutoff)
 
 
 def _serve(action, debug=False, dry_run=False):
@@ -76,6 +106,7 @@ def _serve(action, debug=False, dry_run=False):
     print ' '.join(argv)
     if dry_run:
         return
+    import paste.script.command
     # Configure logging and lock file
     if action in ('start', 'stop', 'restart', 'status'):
         argv += [
@@ -90,6 +121,7 @@ def _serve(action, debug=False, dry_run=False):
 # bin/flask-ctl ...
 def run():
     """Run command"""
+    import werkzeug.script
     action_shell = werkzeug.script.make_shell(make_shell, make_shell.__doc__)
 
     # bin/flask-ctl serve [fg|start|stop|restart|status]
@@ -0,0 +1,492 @@
+# -*- coding: utf-8 -*-
+"""Storage backends used by per-user views.
+
+Backend is selected with 'STORAGE' config key:
+ - 'memory' (default) aggregates data returned by get_data,
+ - 'sqlite' imports DATA_CSV into SQLite database at 'STORAGE_DB' and
+   aggregates it with SQL queries,
+ - 'lazy' indexes byte offsets of users' rows in DATA_CSV and parses rows
+   of a user on first access, keeping up to 'LAZY_CACHE_SIZE' users.
+"""
+
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from datetime import (
+    datetime,
+    time,
+)
+from json import (
+    dumps,
+    loads,
+)
+
+from presence_analyzer.main import app
+from presence_analyzer.rollup import get_rollup
+from presence_analyzer.utils import (
+    INGESTION,
+    SNAPSHOT,
+    daily_presence,
+    finish_report,
+    get_daily_presence,
+    get_data,
+    get_histograms,
+    get_snapshot,
+    iter_presence_rows,
+    iter_user_rows,
+    new_report,
+    parse_presence_rows,
+    user_histograms,
+    seconds_since_midnight,
+    locker,
+)
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+SCHEMA = (
+    'CREATE TABLE presence ('
+    ' user_id INTEGER NOT NULL,'
+    ' date TEXT NOT NULL,'
+    ' weekday INTEGER NOT NULL,'
+    ' start_time INTEGER NOT NULL,'
+    ' end_time INTEGER NOT NULL,'
+    ' PRIMARY KEY (user_id, date))',
+    'CREATE TABLE source (path TEXT NOT NULL, mtime REAL NOT NULL)',
+    'CREATE TABLE ingestion (report TEXT NOT NULL)',
+)
+
+USER_ENTRIES = (
+    'SELECT date, start_time, end_time FROM presence'
+    ' WHERE user_id = ? ORDER BY date'
+)
+
+USER_IDS = 'SELECT DISTINCT user_id FROM presence ORDER BY user_id'
+
+INSERT_ROW = 'INSERT OR REPLACE INTO presence VALUES (?, ?, ?, ?, ?)'
+
+WEEKDAY_STATS = (
+    'SELECT weekday, COUNT(*), SUM(end_time - start_time),'
+    ' SUM(start_time), SUM(end_time)'
+    ' FROM presence WHERE user_id = ? AND date >= ? GROUP BY weekday'
+)
+
+# source (path, mtime) of the imported database
+IMPORTED = {'source': None}
+
+# LazyIndex of current DATA_CSV
+LAZY = {'index': None}
+
+CONNECTIONS = threading.local()
+
+
+def empty_weekday_stats():
+    """Creates empty aggregates for each weekday."""
+    return {
+        i: {'count': 0, 'presence': 0, 'start': 0, 'end': 0}
+        for i in range(7)
+    }
+
+
+def aggregate_weekdays(items, since=None):
+    """Aggregates presence entries of a user by weekday, leaving out ones
+    dated before 'since'.
+    """
+    result = empty_weekday_stats()
+    for date, times in items.iteritems():
+        if since is not None and date < since:
+            continue
+        start = seconds_since_midnight(times['start'])
+        end = seconds_since_midnight(times['end'])
+        stats = result[date.weekday()]
+        stats['count'] += 1
+        stats['presence'] += end - start
+        stats['start'] += start
+        stats['end'] += end
+    return result
+
+
+def memory_weekday_stats(user_id, since):
+    """Aggregates presence of given user from data loaded by get_data.
+    Snapshot's aggregates are built with cutoff of its roll-up already.
+    """
+    snapshot = get_snapshot()
+    if snapshot is not None and snapshot.weekdays is not None:
+        return snapshot.weekdays.get(user_id)
+
+    data = get_data()
+    if user_id not in data:
+        return None
+    return aggregate_weekdays(data[user_id], since)
+
+
+def lazy_weekday_stats(user_id, since):
+    """Aggregates presence of given user parsed on demand."""
+    items = get_lazy_index().get(user_id)
+    if items is None:
+        return None
+    return aggregate_weekdays(items, since)
+
+
+def sqlite_weekday_stats(user_id, since):
+    """Aggregates presence of given user in SQLite database."""
+    rows = get_connection().execute(
+        WEEKDAY_STATS,
+        (user_id, since.isoformat() if since is not None else ''),
+    ).fetchall()
+    if not rows:
+        return None
+
+    result = empty_weekday_stats()
+    for weekday, count, presence, start, end in rows:
+        result[weekday] = {
+            'count': count,
+            'presence': presence,
+            'start': start,
+            'end': end,
+        }
+    return result
+
+
+BACKENDS = {
+    'memory': memory_weekday_stats,
+    'sqlite': sqlite_weekday_stats,
+    'lazy': lazy_weekday_stats,
+}
+
+
+def get_weekday_stats(user_id):
+    """Returns presence aggregates of given user grouped by weekday.
+
+    It creates structure like this:
+    stats = {
+        0: {'count': 2, 'presence': 57600, 'start': 64800, 'end': 122400},
+        1: {'count': 0, 'presence': 0, 'start': 0, 'end': 0},
+        ...
+    }
+    where 'presence', 'start' and 'end' are sums in seconds. Aggregates
+    rolled up from old data are included instead of raw entries dated
+    before roll-up cutoff. Returns None for unknown user.
+    """
+    cutoff, rollup = get_rollup()
+    stats = BACKENDS[app.config.get('STORAGE', 'memory')](user_id, cutoff)
+    rolled_up = rollup.get(user_id)
+    if rolled_up is None:
+        return stats
+
+    result = empty_weekday_stats()
+    for weekdays in (stats or {}, rolled_up):
+        for weekday, totals in weekdays.iteritems():
+            for name, value in totals.iteritems():
+                result[weekday][name] += value
+    return result
+
+
+def get_user_entries(user_id):
+    """Returns entries of given user like get_data()[user_id] read from
+    current backend. Returns None for unknown user.
+    """
+    backend = app.config.get('STORAGE', 'memory')
+    if backend == 'sqlite':
+        return sqlite_user_entries(user_id)
+    if backend == 'lazy':
+        return get_lazy_index().get(user_id)
+    return get_data().get(user_id)
+
+
+def sqlite_user_entries(user_id):
+    """Reads entries of given user from SQLite database."""
+    rows = get_connection().execute(USER_ENTRIES, (user_id,)).fetchall()
+    if not rows:
+        return None
+    return {
+        datetime.strptime(date, '%Y-%m-%d').date(): {
+            'start': time_of_day(start),
+            'end': time_of_day(end),
+        }
+        for date, start, end in rows
+    }
+
+
+def time_of_day(seconds):
+    """Converts seconds since midnight to time."""
+    return time(seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+
+def iter_rows(user_id=None, since=None, until=None):
+    """Yields (user_id, date, start, end) tuples like iter_user_rows, read
+    from current backend. Backends other than 'memory' read entries of
+    one user at a time, so all data is never held at once.
+    """
+    backend = app.config.get('STORAGE', 'memory')
+    if backend == 'memory':
+        return iter_user_rows(get_data(), user_id, since, until)
+
+    if backend == 'sqlite':
+        read = sqlite_user_entries
+        if user_id is None:
+            user_ids = [row[0] for row in get_connection().execute(USER_IDS)]
+    else:
+        index = get_lazy_index()
+        read = index.read
+        if user_id is None:
+            user_ids = sorted(index.spans)
+    if user_id is not None:
+        user_ids = [user_id]
+    return (
+        row
+        for user in user_ids
+        for row in iter_user_rows(
+            {user: read(user) or {}}, user, since, until
+        )
+    )
+
+
+def get_user_timeline(user_id):
+    """Returns sorted dates of given user and presence time (in seconds)
+    of each of them as two lists. Returns None for unknown user.
+    """
+    if app.config.get('STORAGE', 'memory') == 'memory':
+        return get_daily_presence(user_id)
+    items = get_user_entries(user_id)
+    if items is None:
+        return None
+    return daily_presence(items)
+
+
+def get_user_histograms(user_id):
+    """Returns bucket length and histograms of given user by weekday, like
+    in get_histograms, or None for unknown user. Backends other than
+    'memory' build them from entries of the user on each call.
+    """
+    if app.config.get('STORAGE', 'memory') == 'memory':
+        histograms = get_histograms()
+        weekdays = histograms['users'].get(user_id)
+        if weekdays is None:
+            return None
+        return histograms['resolution'], weekdays
+
+    items = get_user_entries(user_id)
+    if items is None:
+        return None
+    resolution = app.config.get('HISTOGRAM_RESOLUTION', 60)
+    return resolution, user_histograms(items, resolution)
+
+
+def prepare():
+    """Builds structures used by current backend ahead of requests."""
+    backend = app.config.get('STORAGE', 'memory')
+    if backend == 'sqlite':
+        get_connection()
+    elif backend == 'lazy':
+        get_lazy_index()
+    else:
+        get_data()
+
+
+def csv_source():
+    """Returns (path, mtime) of current DATA_CSV."""
+    path = app.config['DATA_CSV']
+    return path, os.path.getmtime(path)
+
+
+def get_connection():
+    """Returns read-only connection to up to date database. Connections are
+    kept per thread and reopened after database is imported again.
+    """
+    if SNAPSHOT['loader'] is not None and IMPORTED['source'] is not None:
+        # background loader keeps the database up to date
+        source = IMPORTED['source']
+    else:
+        source = csv_source()
+        if IMPORTED['source'] != source:
+            import_csv(source)
+
+    if getattr(CONNECTIONS, 'source', None) != source:
+        if getattr(CONNECTIONS, 'connection', None) is not None:
+            CONNECTIONS.connection.close()
+        connection = sqlite3.connect(app.config['STORAGE_DB'])
+        connection.execute('PRAGMA query_only = ON')
+        CONNECTIONS.connection = connection
+        CONNECTIONS.source = source
+    return CONNECTIONS.connection
+
+
+def imported_source(path):
+    """Returns source (path, mtime) stored in database or None."""
+    if not os.path.exists(path):
+        return None
+    connection = sqlite3.connect(path)
+    try:
+        row = connection.execute('SELECT path, mtime FROM source').fetchone()
+    except sqlite3.DatabaseError:
+        log.debug('Database %s is broken', path, exc_info=True)
+        row = None
+    finally:
+        connection.close()
+    return tuple(row) if row else None
+
+
+@locker
+def import_csv(source):
+    """Imports DATA_CSV into database unless it's already there.
+
+    Database is built aside and renamed, so readers always see either the
+    old or the new one.
+    """
+    path = app.config['STORAGE_DB']
+    if imported_source(path) != source:
+        log.info('Importing %s into %s', source[0], path)
+        started = datetime.now()
+        report = new_report(source[0])
+        tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        connection = sqlite3.connect(tmp_path)
+        try:
+            for statement in SCHEMA:
+                connection.execute(statement)
+            connection.executemany(INSERT_ROW, (
+                (
+                    user_id,
+                    date.isoformat(),
+                    date.weekday(),
+                    seconds_since_midnight(start),
+                    seconds_since_midnight(end),
+                )
+                for user_id, date, start, end
+                in iter_presence_rows(source[0], report)
+            ))
+            finish_report(report, started)
+            connection.execute('INSERT INTO source VALUES (?, ?)', source)
+            connection.execute(
+                'INSERT INTO ingestion VALUES (?)', (dumps(report),)
+            )
+            connection.commit()
+        finally:
+            connection.close()
+        os.rename(tmp_path, path)
+    elif IMPORTED['source'] != source:
+        INGESTION['report'] = imported_report(path)
+    IMPORTED['source'] = source
+
+
+def imported_report(path):
+    """Returns ingestion report stored in database or None."""
+    connection = sqlite3.connect(path)
+    try:
+        row = connection.execute('SELECT report FROM ingestion').fetchone()
+    except sqlite3.DatabaseError:
+        log.debug('Database %s has no ingestion report', path, exc_info=True)
+        row = None
+    finally:
+        connection.close()
+    return loads(row[0]) if row else None
+
+
+class LazyIndex(object):
+    """Byte offsets of users' rows in presence CSV.
+
+    Rows of each user are kept as a list of [offset, length] spans, so
+    a file sorted by user needs a single span per user. Parsed entries of
+    recently used users are kept in a LRU of given size. Offsets are valid
+    only for file of given source (path, mtime).
+    """
+
+    def __init__(self, source, size):
+        self.source = source
+        self.path = source[0]
+        self.size = size
+        self.spans = {}
+        self.records = OrderedDict()
+        self.lock = threading.Lock()
+        self.build()
+
+    def build(self):
+        """Scans the file recording spans of rows of each user. Stores
+        ingestion report of the file in INGESTION.
+        """
+        started = datetime.now()
+        report = new_report(self.path)
+        line = [0, 0]
+        with open(self.path, 'rb') as csvfile:
+            for user_id, _, _, _ in parse_presence_rows(
+                    self.lines(csvfile, line), report):
+                offset, length = line
+                spans = self.spans.setdefault(user_id, [])
+                if spans and sum(spans[-1]) == offset:
+                    spans[-1][1] += length
+                else:
+                    spans.append([offset, length])
+        finish_report(report, started)
+
+    @staticmethod
+    def lines(csvfile, line):
+        """Yields lines of the file keeping [offset, length] of the last
+        one in given list.
+        """
+        for text in csvfile:
+            line[0] += line[1]
+            line[1] = len(text)
+            yield text
+
+    def load(self, user_id):
+        """Parses entries of given user from the file."""
+        lines = []
+        with open(self.path, 'rb') as csvfile:
+            for offset, length in self.spans[user_id]:
+                csvfile.seek(offset)
+                lines.extend(csvfile.read(length).splitlines())
+        items = {}
+        for row_user_id, date, start, end in parse_presence_rows(lines):
+            if row_user_id == user_id:
+                items[date] = {'start': start, 'end': end}
+        return items
+
+    def read(self, user_id):
+        """Parses entries of given user without keeping them. Returns None
+        for unknown user.
+        """
+        if user_id not in self.spans:
+            return None
+        return self.load(user_id)
+
+    def get(self, user_id):
+        """Returns entries of given user like get_data()[user_id] or None
+        for unknown user.
+        """
+        if user_id not in self.spans:
+            return None
+        with self.lock:
+            items = self.records.pop(user_id, None)
+        if items is None:
+            items = self.load(user_id)
+        with self.lock:
+            self.records[user_id] = items
+            while len(self.records) > self.size:
+                self.records.popitem(last=False)
+        return items
+
+
+def get_lazy_index():
+    """Returns LazyIndex of current DATA_CSV. It's rebuilt after the file
+    changes, also while background loader is running, as offsets of the
+    old file are wrong in the new one.
+    """
+    index = LAZY['index']
+    source = csv_source()
+    if index is None or index.source != source:
+        index = build_lazy_index(source)
+    return index
+
+
+@locker
+def build_lazy_index(source):
+    """Indexes DATA_CSV of given source unless it's already indexed."""
+    index = LAZY['index']
+    if index is None or index.source != source:
+        log.info('Indexing %s', source[0])
+        index = LazyIndex(source, app.config.get('LAZY_CACHE_SIZE', 100))
+        LAZY['index'] = index
+    return index
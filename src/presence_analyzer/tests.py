@@ -2,13 +2,30 @@
 """Presence analyzer unit tests."""
 import os.path
 import json
+import time
+import shutil
 import datetime
+import tempfile
+import threading
 import unittest
+import BaseHTTPServer
+from StringIO import StringIO
+
+from werkzeug.exceptions import HTTPException
+try:
+    from PIL import Image
+except ImportError:
+    Image = None  # pylint: disable-msg=C0103
 
 from presence_analyzer import (
     main,
     views,
     utils,
+    storage,
+    loader,
+    warmup,
+    rollup,
+    update,
 )
 
 TEST_DATA_CSV = os.path.join(
@@ -24,6 +41,39 @@ TEST_CACHED_DATA = os.path.join(
     'runtime', 'data', 'test_cache_data.csv'
 )
 
+# 1x1 transparent PNG
+TEST_AVATAR = (
+    '\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01'
+    '\x08\x06\x00\x00\x00\x1f\x15\xc4\x89\x00\x00\x00\x0bIDATx\x9cc`\x00'
+    '\x02\x00\x00\x05\x00\x01z^\xab?\x00\x00\x00\x00IEND\xaeB`\x82'
+)
+
+# views answered by every storage backend
+BACKEND_VIEWS = (
+    '/api/v1/export/csv',
+    '/api/v1/export/ndjson?user_id=11&since=2013-09-10',
+    '/api/v1/export/csv?user_id=12',
+    '/api/v1/timeline/11?bucket=week',
+    '/api/v1/timeline/12',
+    '/api/v1/presence_percentiles/11',
+    '/api/v1/presence_percentiles/12',
+)
+
+
+def check_backend_views(testcase, backend):
+    """Checks views served from given backend match ones of memory storage
+    and don't load all presence data.
+    """
+    client = main.app.test_client()
+    main.app.config['STORAGE'] = 'memory'
+    expected = [client.get(url).data for url in BACKEND_VIEWS]
+    utils.CACHE_DATA = {}
+    main.app.config['STORAGE'] = backend
+    for url, data in zip(BACKEND_VIEWS, expected):
+        testcase.assertEqual(client.get(url).data, data, url)
+    testcase.assertEqual(client.get('/api/v1/occupancy').status_code, 501)
+    testcase.assertNotIn('get_data', utils.CACHE_DATA)
+
 
 # pylint: disable=E1103
 class PresenceAnalyzerViewsTestCase(unittest.TestCase):
@@ -66,6 +116,38 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
             }
         ])
 
+    def test_bootstrap_view(self):
+        """Test data for a page in one response."""
+        result = self.client.get('/api/v1/bootstrap')
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.content_type, 'application/json')
+        data = json.loads(result.data)
+        users = json.loads(self.client.get('/api/v1/users').data)
+        self.assertEqual(data, {u'users': users})
+
+        result = self.client.get('/api/v1/bootstrap?user_id=11')
+        data = json.loads(result.data)
+        self.assertEqual(data['user_id'], 11)
+        self.assertItemsEqual(data['stats'].keys(), [
+            u'mean_time_weekday',
+            u'presence_weekday',
+            u'presence_start_end',
+            u'presence_percentiles',
+        ])
+        self.assertEqual(
+            data['stats']['presence_weekday'],
+            json.loads(self.client.get('/api/v1/presence_weekday/11').data)
+        )
+
+        result = self.client.get(
+            '/api/v1/bootstrap?user_id=12&stats=presence_start_end'
+        )
+        data = json.loads(result.data)
+        self.assertEqual(data['stats'], {u'presence_start_end': []})
+
+        result = self.client.get('/api/v1/bootstrap?user_id=11&stats=users')
+        self.assertEqual(result.status_code, 400)
+
     def test_users_view(self):
         """Test user view"""
         result = self.client.get('/api/v1/mean_time_weekday/11')
@@ -152,6 +234,168 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
             [u'Sun', 0, 0]
         ])
 
+    def test_presence_percentiles_view(self):
+        """Test percentiles of start, end and presence time for user"""
+        main.app.config['HISTOGRAM_RESOLUTION'] = 1
+        utils.CACHE_DATA = {}
+        result = self.client.get('/api/v1/presence_percentiles/11')
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.content_type, 'application/json')
+        data = json.loads(result.data)
+        self.assertEqual(len(data), 8)
+        self.assertEqual(data[0], [
+            u'Weekday',
+            u'Start p10', u'Start median', u'Start p90',
+            u'End p10', u'End median', u'End p90',
+            u'Presence p10', u'Presence median', u'Presence p90',
+        ])
+        self.assertEqual(data[1], [
+            u'Mon',
+            33134, 33134, 33134,
+            57257, 57257, 57257,
+            24123, 24123, 24123,
+        ])
+        self.assertEqual(data[4], [
+            u'Thu',
+            34088, 34088, 37116,
+            57087, 57087, 60085,
+            22969, 22969, 22999,
+        ])
+        self.assertEqual(data[6], [u'Sat'] + [0] * 9)
+
+        main.app.config['HISTOGRAM_RESOLUTION'] = 60
+        utils.CACHE_DATA = {}
+        result = self.client.get('/api/v1/presence_percentiles/11')
+        data = json.loads(result.data)
+        self.assertEqual(data[4][1:4], [34080, 34080, 37080])
+
+        result = self.client.get('/api/v1/presence_percentiles/12')
+        self.assertEqual(json.loads(result.data), [])
+
+    def test_timeline_view(self):
+        """Test presence of user over time."""
+        result = self.client.get('/api/v1/timeline/11')
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.content_type, 'application/json')
+        data = json.loads(result.data)
+        self.assertEqual(len(data), 7)
+        self.assertEqual(data[0], [u'Date', u'Presence (s)', u'Mean (s)',
+                                   u'Days'])
+        self.assertEqual(data[1], [u'2013-09-05', 22999, 22999, 1])
+
+        result = self.client.get(
+            '/api/v1/timeline/11?bucket=week&since=2013-09-06'
+        )
+        data = json.loads(result.data)
+        self.assertEqual(data[1:], [[u'2013-09-09', 95403, 19080.6, 5]])
+
+        result = self.client.get('/api/v1/timeline/11?bucket=month')
+        data = json.loads(result.data)
+        self.assertEqual(data[1:], [
+            [u'2013-09-01', 118402, 118402 / 6.0, 6],
+        ])
+
+        main.app.config['TIMELINE_MAX_POINTS'] = 3
+        result = self.client.get('/api/v1/timeline/11')
+        main.app.config['TIMELINE_MAX_POINTS'] = 500
+        data = json.loads(result.data)
+        self.assertEqual(data[1:], [
+            [u'2013-09-02', 22999, 22999, 1],
+            [u'2013-09-09', 95403, 19080.6, 5],
+        ])
+
+        result = self.client.get('/api/v1/timeline/12')
+        self.assertEqual(json.loads(result.data), [])
+        result = self.client.get('/api/v1/timeline/11?bucket=year')
+        self.assertEqual(result.status_code, 400)
+
+    def test_export_csv(self):
+        """Test streaming rows as CSV."""
+        result = self.client.get('/api/v1/export/csv')
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.mimetype, 'text/csv')
+        self.assertTrue(result.is_streamed)
+        lines = result.data.splitlines()
+        self.assertEqual(len(lines), 9)
+        self.assertEqual(lines[0], '10,2013-09-10,09:39:05,17:59:52')
+        self.assertEqual(lines[3], '11,2013-09-05,09:28:08,15:51:27')
+
+        result = self.client.get(
+            '/api/v1/export/csv?user_id=11&since=2013-09-10&until=2013-09-12'
+        )
+        self.assertEqual(result.data.splitlines(), [
+            '11,2013-09-10,09:19:50,13:55:54',
+            '11,2013-09-11,09:13:26,16:15:27',
+            '11,2013-09-12,10:18:36,16:41:25',
+        ])
+
+    def test_export_ndjson(self):
+        """Test streaming rows as NDJSON."""
+        result = self.client.get('/api/v1/export/ndjson?user_id=10')
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.content_type, 'application/x-ndjson')
+        rows = [json.loads(line) for line in result.data.splitlines()]
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[0], {
+            u'user_id': 10,
+            u'date': u'2013-09-10',
+            u'start': u'09:39:05',
+            u'end': u'17:59:52',
+        })
+
+        result = self.client.get('/api/v1/export/ndjson?user_id=12')
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.data, '')
+
+    def test_export_errors(self):
+        """Test export with wrong parameters."""
+        result = self.client.get('/api/v1/export/xml')
+        self.assertEqual(result.status_code, 404)
+        result = self.client.get('/api/v1/export/csv?since=yesterday')
+        self.assertEqual(result.status_code, 400)
+        result = self.client.get('/api/v1/export/csv?user_id=abc')
+        self.assertEqual(result.status_code, 400)
+
+    def test_occupancy_view(self):
+        """Test number of people present by weekday."""
+        result = self.client.get('/api/v1/occupancy?resolution=60')
+        self.assertEqual(result.status_code, 200)
+        data = json.loads(result.data)
+        self.assertEqual(len(data), 25)
+        self.assertEqual(
+            data[0],
+            [u'Time', u'Mon', u'Tue', u'Wed', u'Thu', u'Fri', u'Sat', u'Sun']
+        )
+        self.assertEqual(data[1], [u'00:00', 0, 0, 0, 0, 0, 0, 0])
+        self.assertEqual(data[10], [u'09:00', 1, 2, 2, 0.5, 0, 0, 0])
+        self.assertEqual(data[11], [u'10:00', 1, 2, 2, 1.5, 0, 0, 0])
+        self.assertEqual(data[15][2], 1)
+
+        result = self.client.get(
+            '/api/v1/occupancy?since=2013-09-06&until=2013-09-12'
+        )
+        data = json.loads(result.data)
+        self.assertEqual(len(data), 97)
+        self.assertEqual(data[43], [u'10:30', 1, 2, 2, 1, 0, 0, 0])
+
+    def test_occupancy_view_errors(self):
+        """Test occupancy with wrong parameters."""
+        for query in ('resolution=0', 'resolution=x', 'since=2013'):
+            result = self.client.get('/api/v1/occupancy?' + query)
+            self.assertEqual(result.status_code, 400)
+
+    def test_ingestion_view(self):
+        """Test report of loading data."""
+        utils.CACHE_DATA = {}
+        result = self.client.get('/api/v1/ingestion')
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.content_type, 'application/json')
+        data = json.loads(result.data)
+        self.assertEqual(data['source'], TEST_DATA_CSV)
+        self.assertEqual(data['rows'], 9)
+        self.assertEqual(data['rejected'], 0)
+        self.assertEqual(data['sample'], [])
+
     def test_template_render(self):
         """Test rendering templates"""
         data_list = [
@@ -173,6 +417,82 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
             self.assertEqual(result.content_type, 'text/html; charset=utf-8')
             self.assertIn(data['unique'], result.data)
 
+    def test_template_render_etag(self):
+        """Test pages are rendered once and served with ETag."""
+        utils.PAGES.clear()
+        result = self.client.get('/presence_weekday.html')
+        etag = result.headers['ETag']
+        self.assertIn('no-cache', result.headers['Cache-Control'])
+        self.assertIn('presence_weekday.html', utils.PAGES)
+
+        result = self.client.get(
+            '/presence_weekday.html', headers={'If-None-Match': etag}
+        )
+        self.assertEqual(result.status_code, 304)
+        self.assertEqual(result.data, '')
+
+        utils.PAGES['presence_weekday.html'].update({
+            'body': 'cached',
+            'etag': 'etag',
+        })
+        result = self.client.get('/presence_weekday.html')
+        self.assertEqual(result.data, 'cached')
+
+        utils.CACHE_DATA.pop('get_users_data')
+        result = self.client.get('/presence_weekday.html')
+        self.assertEqual(result.headers['ETag'], etag)
+        self.assertNotEqual(result.data, 'cached')
+        utils.PAGES.clear()
+
+    def test_template_render_bootstrap(self):
+        """Test users listing embedded in pages."""
+        result = self.client.get('/presence_start_end.html')
+        self.assertIn(
+            'var BOOTSTRAP = {0};'.format(json.dumps({
+                'users': utils.get_sorted_users(),
+            })),
+            result.data
+        )
+
+    def test_static_fingerprint(self):
+        """Test content hashes in URLs of static files."""
+        fingerprint = utils.static_fingerprint('css/base.css')
+        self.assertEqual(len(fingerprint), 12)
+        self.assertIsNone(utils.static_fingerprint('css/missing.css'))
+
+        result = self.client.get('/mean_time_weekday.html')
+        url = '/static/css/base.css?v={0}'.format(fingerprint)
+        self.assertIn(url, result.data)
+
+        result = self.client.get(url)
+        self.assertEqual(result.status_code, 200)
+        self.assertIn('max-age=31536000', result.headers['Cache-Control'])
+        self.assertIn('public', result.headers['Cache-Control'])
+
+        result = self.client.get('/static/css/base.css?v=old')
+        self.assertNotIn('max-age=31536000', result.headers['Cache-Control'])
+
+    def test_static_fingerprint_unknown(self):
+        """Test only files of static folder are hashed and remembered."""
+        utils.STATIC_FINGERPRINTS.clear()
+        for filename in (
+                'css/missing.css',
+                '../../../../etc/hostname',
+                '../utils.py',
+                'css/../../views.py'):
+            self.assertIsNone(utils.static_fingerprint(filename))
+            result = self.client.get('/static/{0}?v=x'.format(filename))
+            self.assertEqual(result.status_code, 404)
+            cache_control = result.headers.get('Cache-Control', '')
+            self.assertNotIn('max-age', cache_control)
+        self.assertEqual(utils.STATIC_FINGERPRINTS, {})
+
+        fingerprint = utils.static_fingerprint('css/base.css')
+        self.assertEqual(
+            utils.static_fingerprint('css/./base.css'), fingerprint
+        )
+        self.assertEqual(utils.STATIC_FINGERPRINTS.keys(), ['css/base.css'])
+
     def test_template_render_secon(self):
         """Second testing function simulating real tests
         Especially for you
@@ -293,6 +613,261 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         self.assertEqual(utils.mean([1.1, 1.2, 1.3, 1.4]), 1.25)
         self.assertEqual(utils.mean([]), 0)
 
+    def test_cache_by_data(self):
+        """Test results are cached until data is reloaded."""
+        calls = []
+
+        @utils.cache_by_data("decorated function", 2)
+        def decorated_function(data, value):
+            """Function used to test cache decorator."""
+            calls.append(value)
+            return len(data) + value
+
+        self.assertEqual(decorated_function(1), 3)
+        self.assertEqual(decorated_function(1), 3)
+        self.assertEqual(calls, [1])
+        decorated_function(2)
+        decorated_function(3)
+        decorated_function(1)
+        self.assertEqual(calls, [1, 2, 3, 1])
+
+        utils.CACHE_DATA.pop('get_data')
+        decorated_function(1)
+        self.assertEqual(calls, [1, 2, 3, 1, 1])
+
+    def test_cache_by_data_concurrent(self):
+        """Test concurrent callers compute a missing result once."""
+        calls = []
+
+        @utils.cache_by_data("concurrent function")
+        def decorated_function(data, value):
+            """Function used to test cache decorator."""
+            calls.append(value)
+            time.sleep(0.05)
+            return value
+
+        utils.get_data()
+        threads = [
+            threading.Thread(target=decorated_function, args=(value % 2,))
+            for value in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertItemsEqual(calls, [0, 1])
+
+    def test_get_occupancy(self):
+        """Test accumulation of presence intervals."""
+        result = utils.get_occupancy(None, None, 1)
+        self.assertEqual(len(result), 7)
+        self.assertEqual(len(result[1]), 24 * 60)
+        self.assertEqual(result[1][9 * 60 + 19], 1)
+        self.assertEqual(result[1][9 * 60 + 39], 2)
+        self.assertEqual(result[1][13 * 60 + 55], 1)
+        self.assertEqual(result[1][17 * 60 + 59], 0)
+        self.assertEqual(result[5], [0] * 24 * 60)
+        self.assertIs(utils.get_occupancy(None, None, 1), result)
+
+    def test_histogram_percentile(self):
+        """Test percentiles read from histogram."""
+        histogram = utils.cumulate({9: 1, 1: 2, 5: 7})
+        self.assertEqual(histogram, ([1, 5, 9], [2, 9, 10]))
+        self.assertEqual(utils.histogram_percentile(histogram, 10, 60), 60)
+        self.assertEqual(utils.histogram_percentile(histogram, 20, 60), 60)
+        self.assertEqual(utils.histogram_percentile(histogram, 21, 60), 300)
+        self.assertEqual(utils.histogram_percentile(histogram, 90, 60), 300)
+        self.assertEqual(utils.histogram_percentile(histogram, 100, 60), 540)
+        self.assertEqual(utils.histogram_percentile(histogram, 0, 60), 60)
+        self.assertEqual(
+            utils.histogram_percentile(utils.cumulate({}), 50, 60), 0
+        )
+
+    def test_choose_bucket(self):
+        """Test choosing bucket for range of dates."""
+        since = datetime.date(2013, 1, 1)
+        self.assertEqual(
+            utils.choose_bucket(since, datetime.date(2013, 1, 10), 10), 'day'
+        )
+        self.assertEqual(
+            utils.choose_bucket(since, datetime.date(2013, 1, 11), 10), 'week'
+        )
+        self.assertEqual(
+            utils.choose_bucket(since, datetime.date(2014, 1, 1), 10), 'month'
+        )
+
+    def test_downsample(self):
+        """Test grouping dates into buckets."""
+        dates = [
+            datetime.date(2013, 9, 27),
+            datetime.date(2013, 9, 30),
+            datetime.date(2013, 10, 1),
+            datetime.date(2013, 10, 3),
+        ]
+        values = [1, 2, 3, 4]
+        since = datetime.date(2013, 9, 28)
+        until = datetime.date(2013, 10, 31)
+        self.assertEqual(
+            utils.downsample(dates, values, since, until, 'month'),
+            [(datetime.date(2013, 9, 1), 2, 1),
+             (datetime.date(2013, 10, 1), 7, 2)]
+        )
+        self.assertEqual(
+            utils.downsample(dates, values, dates[0], until, 'week'),
+            [(datetime.date(2013, 9, 23), 1, 1),
+             (datetime.date(2013, 9, 30), 9, 3)]
+        )
+        self.assertEqual(
+            utils.downsample(dates, values, until, until, 'day'), []
+        )
+
+    def test_parse_data_rejects(self):
+        """Test malformed rows are skipped and reported."""
+        tmp_dir = tempfile.mkdtemp()
+        path = os.path.join(tmp_dir, 'data.csv')
+        with open(path, 'w') as csvfile:
+            csvfile.write(
+                'user_id,date,start,end\n'
+                '10,2013-09-10,09:39:05,17:59:52\n'
+                'x,2013-09-11,09:19:52,16:07:37\n'
+                '10,2013-13-11,09:19:52,16:07:37\n'
+                '10,2013-09-12,10:48:46,25:00:00\n'
+                '11,2013-09-05,09:28:08,15:51:27\n'
+                'generated on 2013-09-13\n'
+            )
+        try:
+            data = utils.parse_data(path)
+        finally:
+            shutil.rmtree(tmp_dir)
+        self.assertEqual(data, {
+            10: {
+                datetime.date(2013, 9, 10): {
+                    'start': datetime.time(9, 39, 5),
+                    'end': datetime.time(17, 59, 52),
+                },
+            },
+            11: {
+                datetime.date(2013, 9, 5): {
+                    'start': datetime.time(9, 28, 8),
+                    'end': datetime.time(15, 51, 27),
+                },
+            },
+        })
+        report = utils.INGESTION['report']
+        self.assertEqual(report['source'], path)
+        self.assertEqual(report['rows'], 2)
+        self.assertEqual(report['rejected'], 5)
+        self.assertEqual(report['reasons'], {
+            'columns': 1,
+            'user_id': 2,
+            'date': 1,
+            'end': 1,
+        })
+        self.assertEqual(report['sample'], [
+            [1, 'user_id'],
+            [3, 'user_id'],
+            [4, 'date'],
+            [5, 'end'],
+            [7, 'columns'],
+        ])
+        self.assertIsNotNone(report['parse_time'])
+
+    def test_rejected_sample(self):
+        """Test number of listed rejected rows is bounded."""
+        report = utils.new_report('data.csv')
+        lines = ['wrong'] * (utils.REJECTED_SAMPLE + 5)
+        self.assertEqual(list(utils.parse_presence_rows(lines, report)), [])
+        self.assertEqual(report['rejected'], utils.REJECTED_SAMPLE + 5)
+        self.assertEqual(len(report['sample']), utils.REJECTED_SAMPLE)
+
+    def test_single_flight(self):
+        """Test concurrent calls with the same key share one call."""
+        calls = []
+        started = threading.Event()
+        release = threading.Event()
+        results = []
+
+        def function():
+            """Function blocking until released."""
+            calls.append(1)
+            started.set()
+            release.wait()
+            return 'result'
+
+        def call():
+            """Calls function through single_flight."""
+            results.append(utils.single_flight('key', function))
+
+        threads = [threading.Thread(target=call) for _ in xrange(5)]
+        threads[0].start()
+        started.wait()
+        for thread in threads[1:]:
+            thread.start()
+        while len(utils.IN_FLIGHT) != 1:
+            time.sleep(0.001)
+        time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(calls, [1])
+        self.assertEqual(results, ['result'] * 5)
+        self.assertEqual(utils.IN_FLIGHT, {})
+
+    def test_single_flight_error(self):
+        """Test errors are raised and calls aren't kept."""
+        def function():
+            """Failing function."""
+            raise ValueError()
+
+        self.assertRaises(ValueError, utils.single_flight, 'key', function)
+        self.assertEqual(utils.IN_FLIGHT, {})
+        self.assertEqual(utils.single_flight('key', lambda: 1), 1)
+
+    def test_jsonify_load_shedding(self):
+        """Test 503 response when too many requests are waiting."""
+        main.app.config.update({'API_CONCURRENCY': 1, 'API_QUEUE': 0})
+        utils.LIMITERS.clear()
+        started = threading.Event()
+        release = threading.Event()
+
+        @utils.jsonify
+        def blocking_view(value):
+            """View blocking until released."""
+            started.set()
+            release.wait()
+            return value
+
+        def call():
+            """Calls the view within a request."""
+            with main.app.test_request_context('/first'):
+                blocking_view(1)
+
+        thread = threading.Thread(target=call)
+        thread.start()
+        started.wait()
+        try:
+            with main.app.test_request_context('/second'):
+                with self.assertRaises(HTTPException) as context:
+                    blocking_view(2)
+            self.assertEqual(context.exception.code, 503)
+        finally:
+            release.set()
+            thread.join()
+            del main.app.config['API_CONCURRENCY']
+            del main.app.config['API_QUEUE']
+            utils.LIMITERS.clear()
+
+        with main.app.test_request_context('/second'):
+            self.assertEqual(blocking_view(2).data, '2')
+
+    def test_chunked(self):
+        """Test joining lines into chunks."""
+        self.assertEqual(
+            list(utils.chunked(['a\n', 'b\n', 'c\n'], 2)),
+            ['a\nb\n', 'c\n']
+        )
+        self.assertEqual(list(utils.chunked([], 2)), [])
+
     def test_get_users_data(self):
         """Test returned data from xml"""
         data = utils.get_users_data()
@@ -355,11 +930,736 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         })
 
 
+class PresenceAnalyzerStorageTestCase(unittest.TestCase):
+    """SQLite storage backend tests."""
+
+    def setUp(self):
+        """Before each test, set up a environment."""
+        self.tmp_dir = tempfile.mkdtemp()
+        main.app.config.update({
+            'DATA_CSV': TEST_DATA_CSV,
+            'DATA_XML': TEST_DATA_XML,
+            'STORAGE': 'sqlite',
+            'STORAGE_DB': os.path.join(self.tmp_dir, 'presence.sqlite'),
+        })
+        storage.IMPORTED['source'] = None
+        utils.CACHE_DATA = {}
+        self.client = main.app.test_client()
+
+    def tearDown(self):
+        """Get rid of unused objects after each test."""
+        main.app.config['STORAGE'] = 'memory'
+        storage.CONNECTIONS.source = None
+        shutil.rmtree(self.tmp_dir)
+
+    def test_import_csv(self):
+        """Test importing CSV file into database."""
+        source = storage.csv_source()
+        storage.import_csv(source)
+        self.assertEqual(
+            storage.imported_source(main.app.config['STORAGE_DB']),
+            source
+        )
+        rows = storage.get_connection().execute(
+            'SELECT COUNT(*) FROM presence'
+        ).fetchone()
+        self.assertEqual(rows[0], 9)
+
+    def test_views(self):
+        """Test views served from database."""
+        check_backend_views(self, 'sqlite')
+
+    def test_ingestion(self):
+        """Test ingestion report of imported file."""
+        utils.INGESTION['report'] = None
+        result = self.client.get('/api/v1/ingestion')
+        data = json.loads(result.data)
+        self.assertEqual(data['source'], TEST_DATA_CSV)
+        self.assertEqual(data['rows'], 9)
+        self.assertNotIn('get_data', utils.CACHE_DATA)
+
+        # report is kept in database already imported by another process
+        utils.INGESTION['report'] = None
+        storage.IMPORTED['source'] = None
+        result = self.client.get('/api/v1/ingestion')
+        self.assertEqual(json.loads(result.data), data)
+
+    def test_reimport_csv(self):
+        """Test database follows changes of DATA_CSV."""
+        self.assertIsNotNone(storage.get_weekday_stats(11))
+        main.app.config['DATA_CSV'] = TEST_CACHED_DATA
+        self.assertIsNone(storage.get_weekday_stats(11))
+        stats = storage.get_weekday_stats(10)
+        self.assertEqual(stats[1], {
+            'count': 1,
+            'presence': 30047,
+            'start': 34745,
+            'end': 64792,
+        })
+
+    def test_weekday_stats(self):
+        """Test SQL aggregates match in-memory ones."""
+        for user_id in (10, 11, 12):
+            result = storage.get_weekday_stats(user_id)
+            main.app.config['STORAGE'] = 'memory'
+            self.assertEqual(result, storage.get_weekday_stats(user_id))
+            main.app.config['STORAGE'] = 'sqlite'
+
+    def test_views(self):
+        """Test views served from SQLite database."""
+        result = self.client.get('/api/v1/presence_weekday/11')
+        self.assertEqual(result.status_code, 200)
+        data = json.loads(result.data)
+        self.assertEqual(data[4], [u'Thu', 45968])
+
+        result = self.client.get('/api/v1/presence_start_end/11')
+        data = json.loads(result.data)
+        self.assertEqual(data[3], [u'Thu', 35602.0, 58586.0])
+
+        result = self.client.get('/api/v1/mean_time_weekday/12')
+        self.assertEqual(json.loads(result.data), [])
+
+
+class PresenceAnalyzerLazyStorageTestCase(unittest.TestCase):
+    """Lazy storage backend tests."""
+
+    def setUp(self):
+        """Before each test, set up a environment."""
+        main.app.config.update({
+            'DATA_CSV': TEST_DATA_CSV,
+            'DATA_XML': TEST_DATA_XML,
+            'STORAGE': 'lazy',
+            'LAZY_CACHE_SIZE': 1,
+        })
+        utils.CACHE_DATA = {}
+        storage.LAZY['index'] = None
+        self.client = main.app.test_client()
+
+    def tearDown(self):
+        """Get rid of unused objects after each test."""
+        main.app.config['STORAGE'] = 'memory'
+        storage.LAZY['index'] = None
+
+    def test_index(self):
+        """Test offsets of users' rows."""
+        index = storage.get_lazy_index()
+        self.assertItemsEqual(index.spans.keys(), [10, 11])
+        self.assertEqual(len(index.spans[10]), 1)
+        self.assertEqual(index.spans[10][0][0], 0)
+        self.assertEqual(sum(index.spans[10][0]), index.spans[11][0][0])
+        self.assertEqual(index.records, {})
+
+    def test_get(self):
+        """Test parsing entries of a user on first access."""
+        index = storage.get_lazy_index()
+        self.assertEqual(index.get(10), utils.get_data()[10])
+        self.assertEqual(index.records.keys(), [10])
+        self.assertEqual(index.get(11), utils.get_data()[11])
+        self.assertEqual(index.records.keys(), [11])
+        self.assertIsNone(index.get(12))
+
+    def test_weekday_stats(self):
+        """Test lazy aggregates match in-memory ones."""
+        for user_id in (10, 11, 12):
+            result = storage.get_weekday_stats(user_id)
+            main.app.config['STORAGE'] = 'memory'
+            self.assertEqual(result, storage.get_weekday_stats(user_id))
+            main.app.config['STORAGE'] = 'lazy'
+
+    def test_backend_views(self):
+        """Test views served from lazily parsed entries match memory ones."""
+        check_backend_views(self, 'lazy')
+        self.assertEqual(storage.LAZY['index'].records.keys(), [11])
+
+    def test_ingestion(self):
+        """Test ingestion report of indexed file."""
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            data_csv = os.path.join(tmp_dir, 'data.csv')
+            with open(TEST_DATA_CSV) as csv_file:
+                lines = csv_file.readlines()
+            with open(data_csv, 'w') as csv_file:
+                csv_file.writelines(
+                    ['user_id,date,start,end\n'] + lines[:3] +
+                    ['10,2013-13-01,08:00:00,16:00:00\n'] + lines[3:]
+                )
+            main.app.config['DATA_CSV'] = data_csv
+            result = self.client.get('/api/v1/ingestion')
+            data = json.loads(result.data)
+            self.assertEqual(data['rows'], 9)
+            self.assertEqual(data['sample'], [[1, 'user_id'], [5, 'date']])
+            self.assertNotIn('get_data', utils.CACHE_DATA)
+            # rejected rows are left out of spans
+            self.assertEqual(storage.get_lazy_index().spans[10], [
+                [len('user_id,date,start,end\n'), len(''.join(lines[:3]))],
+            ])
+        finally:
+            main.app.config['DATA_CSV'] = TEST_DATA_CSV
+            shutil.rmtree(tmp_dir)
+
+    def test_changed_file(self):
+        """Test index is rebuilt after the file changes."""
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            data_csv = os.path.join(tmp_dir, 'data.csv')
+            shutil.copy(TEST_DATA_CSV, data_csv)
+            main.app.config['DATA_CSV'] = data_csv
+            expected = storage.get_weekday_stats(10)
+            index = storage.get_lazy_index()
+
+            with open(TEST_DATA_CSV) as csv_file:
+                lines = csv_file.readlines()
+            with open(data_csv, 'w') as csv_file:
+                csv_file.writelines(
+                    ['11,2013-09-02,08:00:00,20:00:00\n'] + lines
+                )
+            os.utime(data_csv, (0, os.path.getmtime(data_csv) + 10))
+
+            # index is checked also while background loader is running
+            data_loader = loader.DataLoader(1)
+            data_loader.attempted.set()
+            utils.SNAPSHOT['loader'] = data_loader
+            self.assertIsNot(storage.get_lazy_index(), index)
+            self.assertEqual(storage.get_weekday_stats(10), expected)
+            self.assertEqual(storage.get_weekday_stats(11)[0]['count'], 2)
+        finally:
+            main.app.config['DATA_CSV'] = TEST_DATA_CSV
+            utils.SNAPSHOT.update({'current': None, 'loader': None})
+            shutil.rmtree(tmp_dir)
+
+    def test_views(self):
+        """Test views served from lazily parsed entries."""
+        result = self.client.get('/api/v1/presence_weekday/11')
+        self.assertEqual(result.status_code, 200)
+        data = json.loads(result.data)
+        self.assertEqual(data[4], [u'Thu', 45968])
+
+
+class PresenceAnalyzerLoaderTestCase(unittest.TestCase):
+    """Background loader tests."""
+
+    def setUp(self):
+        """Before each test, set up a environment."""
+        self.tmp_dir = tempfile.mkdtemp()
+        self.data_csv = os.path.join(self.tmp_dir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, self.data_csv)
+        main.app.config.update({
+            'DATA_CSV': self.data_csv,
+            'DATA_XML': TEST_DATA_XML,
+            'LOADER_INTERVAL': 0.01,
+        })
+        utils.CACHE_DATA = {}
+
+    def tearDown(self):
+        """Get rid of unused objects after each test."""
+        if utils.SNAPSHOT['loader'] is not None:
+            utils.SNAPSHOT['loader'].stop()
+        utils.SNAPSHOT.update({'current': None, 'loader': None})
+        main.app.config['LOADER_INTERVAL'] = None
+        shutil.rmtree(self.tmp_dir)
+
+    def test_reload(self):
+        """Test publishing a snapshot."""
+        data_loader = loader.DataLoader(1)
+        snapshot = data_loader.reload(data_loader.sources())
+        self.assertEqual(snapshot.generation, 1)
+        self.assertIs(utils.SNAPSHOT['current'], snapshot)
+        self.assertIs(utils.get_data(), snapshot.data)
+        self.assertIs(utils.get_users_data(), snapshot.users)
+        self.assertEqual(snapshot.data, utils.load_data())
+        self.assertEqual(
+            storage.get_weekday_stats(11),
+            storage.aggregate_weekdays(snapshot.data[11])
+        )
+        self.assertIsNone(storage.get_weekday_stats(12))
+
+    def test_reload_backends(self):
+        """Test snapshot keeps no presence data for other backends."""
+        main.app.config['STORAGE_DB'] = os.path.join(self.tmp_dir, 'db')
+        expected = storage.get_weekday_stats(11)
+        utils.CACHE_DATA = {}
+        try:
+            for backend in ('sqlite', 'lazy'):
+                main.app.config['STORAGE'] = backend
+                data_loader = loader.DataLoader(1)
+                utils.SNAPSHOT['loader'] = data_loader
+                snapshot = data_loader.reload(data_loader.sources())
+                self.assertIsNone(snapshot.data)
+                self.assertIsNone(snapshot.weekdays)
+                self.assertEqual(storage.get_weekday_stats(11), expected)
+            self.assertEqual(storage.IMPORTED['source'], snapshot.sources[0])
+            self.assertEqual(storage.LAZY['index'].source, snapshot.sources[0])
+            self.assertNotIn('get_data', utils.CACHE_DATA)
+        finally:
+            main.app.config['STORAGE'] = 'memory'
+            storage.IMPORTED['source'] = None
+            storage.LAZY['index'] = None
+            utils.SNAPSHOT['loader'] = None
+
+    def test_failed_load(self):
+        """Test requests don't wait for loader after its load failed."""
+        main.app.config.update({
+            'DATA_XML': os.path.join(self.tmp_dir, 'missing.xml'),
+            'LOADER_TIMEOUT': 5,
+        })
+        try:
+            data_loader = loader.start_loader()
+            client = main.app.test_client()
+            started = time.time()
+            for _ in range(3):
+                result = client.get('/api/v1/presence_weekday/10')
+                self.assertEqual(result.status_code, 200)
+            self.assertLess(time.time() - started, 2)
+            self.assertTrue(data_loader.attempted.is_set())
+            self.assertIsNone(utils.SNAPSHOT['current'])
+        finally:
+            main.app.config['DATA_XML'] = TEST_DATA_XML
+            del main.app.config['LOADER_TIMEOUT']
+
+    def test_start_loader(self):
+        """Test loader follows changes of source files."""
+        main.app.config['LOADER_INTERVAL'] = None
+        self.assertIsNone(loader.start_loader())
+
+        main.app.config['LOADER_INTERVAL'] = 0.01
+        data_loader = loader.start_loader()
+        self.assertIs(loader.start_loader(), data_loader)
+        self.assertItemsEqual(utils.get_data().keys(), [10, 11])
+        self.assertEqual(data_loader.generation, 1)
+
+        shutil.copy(TEST_CACHED_DATA, self.data_csv)
+        mtime = os.path.getmtime(self.data_csv) + 10
+        os.utime(self.data_csv, (mtime, mtime))
+        for _ in xrange(500):
+            if data_loader.generation > 1:
+                break
+            time.sleep(0.01)
+        self.assertEqual(data_loader.generation, 2)
+        self.assertItemsEqual(utils.get_data().keys(), [10])
+
+
+class PresenceAnalyzerWarmUpTestCase(unittest.TestCase):
+    """Warm-up and readiness tests."""
+
+    def setUp(self):
+        """Before each test, set up a environment."""
+        main.app.config.update({
+            'DATA_CSV': TEST_DATA_CSV,
+            'DATA_XML': TEST_DATA_XML,
+        })
+        utils.CACHE_DATA = {}
+        self.client = main.app.test_client()
+
+    def tearDown(self):
+        """Get rid of unused objects after each test."""
+        warmup.WARMUP.update({
+            'thread': None,
+            'warmed_at': None,
+            'error': None,
+        })
+        utils.SNAPSHOT.update({'current': None, 'loader': None})
+
+    def test_healthz(self):
+        """Test liveness endpoint."""
+        result = self.client.get('/healthz')
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(json.loads(result.data), {u'status': u'ok'})
+
+    def test_readyz(self):
+        """Test readiness endpoint."""
+        result = self.client.get('/readyz')
+        self.assertEqual(result.status_code, 200)
+        self.assertTrue(json.loads(result.data)['ready'])
+
+        warmup.WARMUP['thread'] = object()
+        result = self.client.get('/readyz')
+        self.assertEqual(result.status_code, 503)
+        self.assertFalse(json.loads(result.data)['ready'])
+
+        warmup.warm_up(views.TEMPLATE_LIST)
+        self.assertIn('get_data', utils.CACHE_DATA)
+        result = self.client.get('/readyz')
+        self.assertEqual(result.status_code, 200)
+        data = json.loads(result.data)
+        self.assertIsNone(data['generation'])
+        self.assertIsNotNone(data['warmed_at'])
+
+    def test_warm_up_failure(self):
+        """Test failed warm-up is reported by readiness endpoint."""
+        main.app.config['DATA_XML'] = '/nonexistent/users.xml'
+        try:
+            warmup.WARMUP['thread'] = object()
+            warmup.warm_up(views.TEMPLATE_LIST)
+        finally:
+            main.app.config['DATA_XML'] = TEST_DATA_XML
+        result = self.client.get('/readyz')
+        self.assertEqual(result.status_code, 503)
+        data = json.loads(result.data)
+        self.assertIsNone(data['warmed_at'])
+        self.assertTrue(data['warmup_error'].startswith('IOError'))
+
+    def test_warm_up_storage(self):
+        """Test warm-up builds histograms only for memory storage."""
+        main.app.config['STORAGE'] = 'lazy'
+        try:
+            warmup.warm_up(views.TEMPLATE_LIST)
+        finally:
+            main.app.config['STORAGE'] = 'memory'
+            storage.LAZY['index'] = None
+        self.assertNotIn('get_data', utils.CACHE_DATA)
+        self.assertIsNotNone(warmup.WARMUP['warmed_at'])
+
+    def test_readyz_loader(self):
+        """Test readiness follows background loader."""
+        data_loader = loader.DataLoader(1)
+        utils.SNAPSHOT['loader'] = data_loader
+        self.assertEqual(self.client.get('/readyz').status_code, 503)
+
+        data_loader.reload(data_loader.sources())
+        result = self.client.get('/readyz')
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(json.loads(result.data)['generation'], 1)
+
+    def test_start_warm_up(self):
+        """Test warm-up runs once in background."""
+        thread = warmup.start_warm_up(views.TEMPLATE_LIST)
+        self.assertIs(warmup.start_warm_up(views.TEMPLATE_LIST), thread)
+        thread.join()
+        self.assertTrue(warmup.readiness()['ready'])
+
+
+class PresenceAnalyzerRollupTestCase(unittest.TestCase):
+    """Roll-up of old data tests."""
+
+    def setUp(self):
+        """Before each test, set up a environment."""
+        self.tmp_dir = tempfile.mkdtemp()
+        self.data_csv = os.path.join(self.tmp_dir, 'data.csv')
+        self.rollup_csv = os.path.join(self.tmp_dir, 'rollup.csv')
+        shutil.copy(TEST_DATA_CSV, self.data_csv)
+        main.app.config.update({
+            'DATA_CSV': self.data_csv,
+            'DATA_XML': TEST_DATA_XML,
+            'ROLLUP_CSV': self.rollup_csv,
+        })
+        utils.CACHE_DATA = {}
+        self.client = main.app.test_client()
+
+    def tearDown(self):
+        """Get rid of unused objects after each test."""
+        del main.app.config['ROLLUP_CSV']
+        utils.CACHE_DATA = {}
+        utils.SNAPSHOT.update({'current': None, 'loader': None})
+        shutil.rmtree(self.tmp_dir)
+
+    def test_rollup_cutoff(self):
+        """Test first day of month of roll-up."""
+        self.assertEqual(
+            rollup.rollup_cutoff(datetime.date(2014, 3, 15), 12),
+            datetime.date(2013, 3, 1)
+        )
+        self.assertEqual(
+            rollup.rollup_cutoff(datetime.date(2014, 1, 31), 1),
+            datetime.date(2013, 12, 1)
+        )
+
+    def test_compact(self):
+        """Test rolling old rows up."""
+        cutoff = datetime.date(2013, 9, 10)
+        self.assertEqual(
+            rollup.compact(self.data_csv, self.rollup_csv, cutoff), 2
+        )
+        with open(self.rollup_csv) as rollup_file:
+            self.assertEqual(rollup_file.read().splitlines(), [
+                'cutoff,2013-09-10',
+                '11,2013-09,0,1,24123,33134,57257',
+                '11,2013-09,3,1,22999,34088,57087',
+            ])
+        with open(self.data_csv) as csv_file:
+            lines = csv_file.read().splitlines()
+        self.assertEqual(len(lines), 7)
+        self.assertEqual(lines[3], '11,2013-09-10,09:19:50,13:55:54')
+
+        # earlier cutoff doesn't bring rows back
+        cutoff = datetime.date(2013, 9, 1)
+        self.assertEqual(
+            rollup.compact(self.data_csv, self.rollup_csv, cutoff), 0
+        )
+        self.assertEqual(
+            rollup.parse_rollup(self.rollup_csv)[0],
+            datetime.date(2013, 9, 10)
+        )
+
+    def test_compact_again(self):
+        """Test rows rolled up before aren't counted twice."""
+        cutoff = datetime.date(2013, 9, 10)
+        rollup.compact(self.data_csv, self.rollup_csv, cutoff)
+        shutil.copy(TEST_DATA_CSV, self.data_csv)
+        rollup.compact(self.data_csv, self.rollup_csv, cutoff)
+        self.assertEqual(rollup.read_rollup(self.rollup_csv), (cutoff, {
+            11: {
+                0: {
+                    'count': 1,
+                    'presence': 24123,
+                    'start': 33134,
+                    'end': 57257,
+                },
+                3: {
+                    'count': 1,
+                    'presence': 22999,
+                    'start': 34088,
+                    'end': 57087,
+                },
+            },
+        }))
+        self.assertEqual(rollup.read_rollup(None), (None, {}))
+
+    def test_weekday_stats(self):
+        """Test views combine roll-ups and recent rows."""
+        expected = {
+            user_id: storage.get_weekday_stats(user_id)
+            for user_id in (10, 11)
+        }
+        rollup.compact(
+            self.data_csv, self.rollup_csv, datetime.date(2013, 9, 12)
+        )
+        utils.CACHE_DATA = {}
+        for user_id in (10, 11):
+            self.assertEqual(
+                storage.get_weekday_stats(user_id), expected[user_id]
+            )
+        self.assertNotIn(datetime.date(2013, 9, 5), utils.get_data()[11])
+
+        result = self.client.get('/api/v1/presence_weekday/11')
+        data = json.loads(result.data)
+        self.assertEqual(data[4], [u'Thu', 45968])
+
+        data_loader = loader.DataLoader(1)
+        snapshot = data_loader.reload(data_loader.sources())
+        self.assertEqual(snapshot.rollup, rollup.read_rollup(self.rollup_csv))
+        self.assertEqual(storage.get_weekday_stats(11), expected[11])
+
+    def test_compact_backends(self):
+        """Test rolled up rows are counted right after compaction by
+        backends following DATA_CSV changes, without background loader.
+        """
+        main.app.config['STORAGE_DB'] = os.path.join(self.tmp_dir, 'db')
+        try:
+            for backend in ('sqlite', 'lazy'):
+                shutil.copy(TEST_DATA_CSV, self.data_csv)
+                if os.path.exists(self.rollup_csv):
+                    os.remove(self.rollup_csv)
+                main.app.config['STORAGE'] = backend
+                expected = storage.get_weekday_stats(11)
+                rollup.compact(
+                    self.data_csv, self.rollup_csv, datetime.date(2013, 9, 10)
+                )
+                self.assertEqual(storage.get_weekday_stats(11), expected)
+                result = self.client.get('/api/v1/presence_weekday/11')
+                data = json.loads(result.data)
+                self.assertEqual(data[1], [u'Mon', 24123])
+                self.assertEqual(data[4], [u'Thu', 45968])
+        finally:
+            main.app.config['STORAGE'] = 'memory'
+            storage.IMPORTED['source'] = None
+            storage.LAZY['index'] = None
+
+    def test_rolled_up_rows_in_data(self):
+        """Test raw rows older than roll-up cutoff aren't counted twice."""
+        main.app.config['STORAGE_DB'] = os.path.join(self.tmp_dir, 'db')
+        expected = {
+            user_id: storage.get_weekday_stats(user_id)
+            for user_id in (10, 11)
+        }
+        rollup.compact(
+            self.data_csv, self.rollup_csv, datetime.date(2013, 9, 12)
+        )
+        # data loaded before compaction is still cached, roll-up is not
+        self.assertEqual(storage.get_weekday_stats(10), expected[10])
+
+        # full history put back
+        shutil.copy(TEST_DATA_CSV, self.data_csv)
+        try:
+            for backend in ('memory', 'sqlite', 'lazy'):
+                main.app.config['STORAGE'] = backend
+                utils.CACHE_DATA = {}
+                for user_id in (10, 11):
+                    self.assertEqual(
+                        storage.get_weekday_stats(user_id), expected[user_id]
+                    )
+            main.app.config['STORAGE'] = 'memory'
+            data_loader = loader.DataLoader(1)
+            data_loader.reload(data_loader.sources())
+            self.assertEqual(storage.get_weekday_stats(10), expected[10])
+        finally:
+            main.app.config['STORAGE'] = 'memory'
+            storage.IMPORTED['source'] = None
+            storage.LAZY['index'] = None
+
+
+class AvatarHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves TEST_AVATAR at /avatar.png, broken response at /broken.png
+    and 404 elsewhere.
+    """
+
+    def do_GET(self):  # pylint: disable-msg=C0103
+        """Handles GET request."""
+        if self.path == '/broken.png':
+            self.wfile.write('HTTP/1.0 abc OK\r\n\r\n')
+            return
+        if self.path != '/avatar.png':
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.end_headers()
+        self.wfile.write(TEST_AVATAR)
+
+    def log_message(self, *args):
+        """Keeps test output clean."""
+        pass
+
+
+class PresenceAnalyzerAvatarsTestCase(unittest.TestCase):
+    """Local avatars tests."""
+
+    def setUp(self):
+        """Before each test, set up a environment."""
+        self.tmp_dir = tempfile.mkdtemp()
+        self.server = BaseHTTPServer.HTTPServer(
+            ('127.0.0.1', 0), AvatarHandler
+        )
+        self.address = 'http://127.0.0.1:{0}'.format(self.server.server_port)
+        server_thread = threading.Thread(target=self.server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        main.app.config.update({
+            'DATA_CSV': TEST_DATA_CSV,
+            'DATA_XML': TEST_DATA_XML,
+            'AVATAR_DIR': self.tmp_dir,
+            'AVATAR_SIZE': 32,
+            'AVATAR_MAX_BYTES': 1024,
+        })
+        utils.CACHE_DATA = {}
+        self.client = main.app.test_client()
+
+    def tearDown(self):
+        """Get rid of unused objects after each test."""
+        self.server.shutdown()
+        self.server.server_close()
+        for name in ('AVATAR_DIR', 'AVATAR_SIZE', 'AVATAR_MAX_BYTES'):
+            del main.app.config[name]
+        utils.CACHE_DATA = {}
+        shutil.rmtree(self.tmp_dir)
+
+    def test_update_avatars(self):
+        """Test storing avatars."""
+        avatars = {
+            '10': self.address + '/avatar.png',
+            '11': self.address + '/missing.png',
+            '12': self.address + '/broken.png',
+        }
+        self.assertEqual(
+            update.update_avatars(avatars, self.tmp_dir, 32, 1024), 1
+        )
+        self.assertEqual(os.listdir(self.tmp_dir), ['10'])
+        with open(os.path.join(self.tmp_dir, '10'), 'rb') as avatar_file:
+            self.assertTrue(avatar_file.read().startswith('\x89PNG'))
+
+        # stored ones are skipped when only missing ones are fetched
+        avatars['10'] = self.address + '/missing.png'
+        self.assertEqual(
+            update.update_avatars(avatars, self.tmp_dir, 32, 1024, True), 0
+        )
+        self.assertEqual(os.listdir(self.tmp_dir), ['10'])
+
+    def test_update_avatars_too_large(self):
+        """Test avatars larger than the limit are skipped."""
+        avatars = {'10': self.address + '/avatar.png'}
+        self.assertEqual(
+            update.update_avatars(avatars, self.tmp_dir, 32, 10), 0
+        )
+        self.assertEqual(os.listdir(self.tmp_dir), [])
+
+    @unittest.skipIf(Image is None, 'PIL is not installed')
+    def test_make_thumbnail(self):
+        """Test scaling avatars down."""
+        image = StringIO()
+        Image.new('RGB', (128, 64)).save(image, 'JPEG')
+        thumbnail = update.make_thumbnail(image.getvalue(), 32)
+        result = Image.open(StringIO(thumbnail))
+        self.assertEqual(result.format, 'PNG')
+        self.assertEqual(result.size, (32, 16))
+
+    def test_refresh_avatars(self):
+        """Test storing avatars of users."""
+        users = {
+            '10': {'name': 'Rando M.', 'avatar': self.address + '/avatar.png'},
+        }
+        self.assertEqual(utils.refresh_avatars(users=users), 1)
+        self.assertTrue(os.path.exists(utils.avatar_path(10)))
+
+    def test_store_avatars(self):
+        """Test storing avatars with config read without Flask."""
+        users = {
+            '11': {'name': 'Not F.', 'avatar': self.address + '/avatar.png'},
+        }
+        self.assertEqual(
+            update.store_avatars(users, {'AVATAR_DIR': self.tmp_dir}), 1
+        )
+        self.assertEqual(os.listdir(self.tmp_dir), ['11'])
+
+    def test_avatar_view(self):
+        """Test serving local avatars."""
+        resp = self.client.get('/avatars/10')
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(
+            resp.headers['Location'],
+            'https://intranet.stxnext.pl/api/images/users/165'
+        )
+        resp = self.client.get('/avatars/99')
+        self.assertEqual(resp.status_code, 404)
+
+        del main.app.config['AVATAR_DIR']
+        try:
+            resp = self.client.get('/avatars/10')
+            self.assertEqual(resp.status_code, 302)
+            resp = self.client.get('/avatars/99')
+            self.assertEqual(resp.status_code, 404)
+        finally:
+            main.app.config['AVATAR_DIR'] = self.tmp_dir
+
+        with open(utils.avatar_path(10), 'wb') as avatar_file:
+            avatar_file.write(TEST_AVATAR)
+        resp = self.client.get('/avatars/10')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'image/png')
+        self.assertEqual(resp.data, TEST_AVATAR)
+        self.assertEqual(
+            resp.headers['Cache-Control'], 'public, max-age=604800'
+        )
+
+    def test_api_users(self):
+        """Test users listing points to local avatars."""
+        resp = self.client.get('/api/v1/users')
+        data = json.loads(resp.data)
+        self.assertEqual(
+            sorted(user['avatar'] for user in data),
+            ['/avatars/10', '/avatars/11']
+        )
+
+
 def suite():
     """Default test suite."""
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(PresenceAnalyzerViewsTestCase))
     suite.addTest(unittest.makeSuite(PresenceAnalyzerUtilsTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerStorageTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerLazyStorageTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerLoaderTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerWarmUpTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerRollupTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerAvatarsTestCase))
     return suite
 
 
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""Downloading of data files and avatars. Imports only the standard
+library up front (lxml and optional PIL are imported when used), so
+command line tools can use it without loading the web stack.
+"""
+
+import os
+import logging
+import httplib
+import urllib2
+from StringIO import StringIO
+from urllib import urlretrieve
+
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+
+def download_xml(address, path):
+    """Downloads users XML file from given address to given path."""
+    return urlretrieve(address, path)
+
+
+def parse_users_data(path):
+    """Extracts users data from XML file."""
+    from lxml import etree
+
+    with open(path, 'r') as xmlfile:
+        data = etree.parse(xmlfile)
+    root = data.getroot()
+    config = root[0]
+    server = {
+        u'protocol': unicode(config.findtext(u'protocol')),
+        u'host': unicode(config.findtext('host'))
+    }
+    address = '{0}://{1}'.format(server['protocol'], server[u'host'])
+    return {
+        user.get('id'): {
+            u'name': user.findtext(u'name'),
+            u'avatar': '{0}{1}'.format(address, user.findtext(u'avatar'))
+        }
+        for user in root[1]
+    }
+
+
+def make_thumbnail(content, size):
+    """Scales image down to fit in size x size pixels and stores it as PNG.
+    Returns content unchanged when PIL isn't installed.
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        return content
+
+    image = Image.open(StringIO(content))
+    image.thumbnail((size, size), Image.ANTIALIAS)
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA')
+    thumbnail = StringIO()
+    image.save(thumbnail, 'PNG')
+    return thumbnail.getvalue()
+
+
+def fetch_avatar(url, max_bytes, timeout=10):
+    """Downloads avatar. Returns None if it's larger than max_bytes."""
+    response = urllib2.urlopen(url, timeout=timeout)
+    try:
+        content = response.read(max_bytes + 1)
+    finally:
+        response.close()
+    if len(content) > max_bytes:
+        return None
+    return content
+
+
+def update_avatars(avatars, directory, size, max_bytes, missing_only=False):
+    """Stores thumbnails of avatars (mapping of user id to URL) in given
+    directory, named by user id. Avatars which can't be fetched or are
+    larger than max_bytes are skipped. Returns number of stored avatars.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    stored = 0
+    for user_id, url in avatars.iteritems():
+        path = os.path.join(directory, str(user_id))
+        if missing_only and os.path.exists(path):
+            continue
+        try:
+            content = fetch_avatar(url, max_bytes)
+            if content is None:
+                log.warning('Avatar of user %s is too large', user_id)
+                continue
+            content = make_thumbnail(content, size)
+        except (IOError, ValueError, httplib.HTTPException):
+            log.warning('Can\'t fetch avatar of user %s from %s', user_id,
+                        url, exc_info=True)
+            continue
+        tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as avatar_file:
+            avatar_file.write(content)
+        os.rename(tmp_path, path)
+        stored += 1
+    return stored
+
+
+def store_avatars(users, config, missing_only=False):
+    """Stores thumbnails of avatars of given users (as returned by
+    parse_users_data) in 'AVATAR_DIR' of given config, which can be read
+    with or without Flask. Returns number of stored avatars.
+    """
+    stored = update_avatars(
+        {
+            user_id: user_data['avatar']
+            for user_id, user_data in users.iteritems()
+        },
+        config['AVATAR_DIR'],
+        config.get('AVATAR_SIZE', 64),
+        config.get('AVATAR_MAX_BYTES', 1048576),
+        missing_only,
+    )
+    log.info('Stored %d avatars', stored)
+    return stored
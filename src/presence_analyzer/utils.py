@@ -1,38 +1,170 @@
 # -*- coding: utf-8 -*-
 """Helper functions used in views."""
 
+import os
 import csv
+import sys
+import math
+import locale
+import posixpath
+import threading
+from bisect import (
+    bisect_left,
+    bisect_right,
+)
 from json import dumps
+from hashlib import md5
 from functools import wraps
 from datetime import (
     datetime,
     timedelta,
 )
 import thread
+from collections import OrderedDict
 
-from flask import Response
-from lxml import etree
+from flask import (
+    abort,
+    request,
+    Response,
+    url_for,
+)
+from flask.ext.mako import render_template
+from flask.helpers import safe_join
+from werkzeug.exceptions import NotFound
 
 from presence_analyzer.main import app
+from presence_analyzer.update import (
+    parse_users_data,
+    store_avatars,
+)
 
 import logging
 log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
 
 CACHE_DATA = {}
 
+MINUTES_PER_DAY = 24 * 60
+
+LOCALE = {'collate': False}
+
+# number of rejected rows listed in ingestion report
+REJECTED_SAMPLE = 20
+
+# report of the last parse_data call
+INGESTION = {'report': None}
+
+# data published by presence_analyzer.loader.DataLoader
+SNAPSHOT = {'current': None, 'loader': None}
+
+# computations shared by concurrent identical requests, by request path
+IN_FLIGHT = {}
+IN_FLIGHT_LOCK = thread.allocate_lock()
+
+# pages rendered from templates, by template name
+PAGES = {}
+
+# content hashes of static files, by file name
+STATIC_FINGERPRINTS = {}
+
+# EndpointLimiter of each endpoint
+LIMITERS = {}
+LIMITERS_LOCK = thread.allocate_lock()
+
 
 def jsonify(function):
     """Creates a response with the JSON representation of wrapped
     function result.
+
+    Concurrent requests for the same path and query string share one
+    computation of the result and at most 'API_CONCURRENCY' different
+    requests of an endpoint are computed at once. Up to 'API_QUEUE' more
+    wait for their turn, others get 503 response right away.
     """
     @wraps(function)
     def inner(*args, **kwargs):
         """Helper function for jsonify fucntion"""
-        return Response(dumps(function(*args, **kwargs)),
+        def compute():
+            """Computes and serializes result within endpoint limit."""
+            with get_limiter(function.__name__):
+                return dumps(function(*args, **kwargs))
+        return Response(single_flight(request.full_path, compute),
                         mimetype='application/json')
+    inner.__wrapped__ = function
     return inner
 
 
+class Flight(object):
+    """Computation shared by concurrent callers."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def single_flight(key, function):
+    """Calls function unless a call with the same key is in progress, in
+    which case waits for and returns its result (or raises its error).
+    """
+    with IN_FLIGHT_LOCK:
+        flight = IN_FLIGHT.get(key)
+        leader = flight is None
+        if leader:
+            flight = IN_FLIGHT[key] = Flight()
+
+    if leader:
+        try:
+            flight.result = function()
+        except BaseException:  # pylint: disable-msg=W0703
+            flight.error = sys.exc_info()
+            raise
+        finally:
+            with IN_FLIGHT_LOCK:
+                del IN_FLIGHT[key]
+            flight.done.set()
+    else:
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error[0], flight.error[1], flight.error[2]
+    return flight.result
+
+
+class EndpointLimiter(object):
+    """Context manager limiting concurrent computations to 'limit'. Aborts
+    with 503 when 'queue' computations are already waiting.
+    """
+
+    def __init__(self, limit, queue):
+        self.semaphore = threading.Semaphore(limit)
+        self.max_pending = limit + queue
+        self.pending = 0
+        self.lock = thread.allocate_lock()
+
+    def __enter__(self):
+        with self.lock:
+            if self.pending >= self.max_pending:
+                abort(503)
+            self.pending += 1
+        self.semaphore.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.semaphore.release()
+        with self.lock:
+            self.pending -= 1
+
+
+def get_limiter(endpoint):
+    """Returns EndpointLimiter of given endpoint."""
+    with LIMITERS_LOCK:
+        if endpoint not in LIMITERS:
+            LIMITERS[endpoint] = EndpointLimiter(
+                app.config.get('API_CONCURRENCY', 8),
+                app.config.get('API_QUEUE', 16)
+            )
+        return LIMITERS[endpoint]
+
+
 def locker(function):
     """Lock given function."""
     function.__lock__ = thread.allocate_lock()
@@ -64,8 +196,38 @@ def cache(name, time):
     return cache_function
 
 
-@locker
-@cache("get_data", 600)
+def cache_by_data(name, size=64, source=None):
+    """Store up to 'size' results of function of loaded data, called with
+    data returned by 'source' (get_data by default) and given arguments.
+    Results are dropped when data is reloaded. Each cache has its own
+    lock, so concurrent callers compute a missing result once.
+    """
+    def cache_function(function):
+        """Get function for cache handler"""
+        lock = thread.allocate_lock()
+
+        @wraps(function)
+        def cache_handler(*args):
+            """Return value from cache. If value doesn't exist compute it."""
+            data = (source or get_data)()
+            with lock:
+                entry = CACHE_DATA.get(name)
+                if entry is None or entry['data'] is not data:
+                    entry = CACHE_DATA[name] = {
+                        'data': data,
+                        'results': OrderedDict(),
+                    }
+                results = entry['results']
+                if args not in results:
+                    results[args] = function(data, *args)
+                    while len(results) > size:
+                        results.popitem(last=False)
+                return results[args]
+        cache_handler.__lock__ = lock
+        return cache_handler
+    return cache_function
+
+
 def get_data():
     """Extracts presence data from CSV file and groups it by user_id.
 
@@ -82,26 +244,172 @@ def get_data():
             },
         }
     }
+
+    Data comes from the current snapshot when background loader is running
+    with 'memory' storage and is loaded on demand otherwise.
+    """
+    snapshot = get_snapshot()
+    if snapshot is not None and snapshot.data is not None:
+        return snapshot.data
+    return load_data()
+
+
+@locker
+@cache("get_data", 600)
+def load_data():
+    """Loads presence data on demand."""
+    return parse_data(app.config['DATA_CSV'])
+
+
+def parse_data(path):
+    """Groups presence entries of CSV file by user_id. Stores ingestion
+    report of the file in INGESTION.
     """
+    started = datetime.now()
+    report = new_report(path)
     data = {}
-    with open(app.config['DATA_CSV'], 'r') as csvfile:
-        presence_reader = csv.reader(csvfile, delimiter=',')
-        for i, row in enumerate(presence_reader):
-            if len(row) != 4:
-                # ignore header and footer lines
-                continue
+    for user_id, date, start, end in iter_presence_rows(path, report):
+        data.setdefault(user_id, {})[date] = {'start': start, 'end': end}
+    finish_report(report, started)
+    return data
+
+
+def finish_report(report, started):
+    """Completes ingestion report of a load started at given time and
+    stores it in INGESTION.
+    """
+    report['parse_time'] = (datetime.now() - started).total_seconds()
+    report['loaded_at'] = datetime.now().isoformat()
+    if report['rejected']:
+        log.warning('Rejected %d rows of %s: %s', report['rejected'],
+                    report['source'], report['reasons'])
+    INGESTION['report'] = report
+
+
+def new_report(path):
+    """Creates empty ingestion report of given file.
+
+    It creates structure like this:
+    report = {
+        'source': '/path/to/data.csv',
+        'rows': 15000,
+        'rejected': 3,
+        'reasons': {'columns': 2, 'date': 1},
+        'sample': [[1, 'columns'], [120, 'date'], [15002, 'columns']],
+        'parse_time': 0.51,
+        'loaded_at': '2013-10-01T09:00:00',
+    }
+    where 'sample' holds line numbers and reasons of up to REJECTED_SAMPLE
+    first rejected rows.
+    """
+    return {
+        'source': path,
+        'rows': 0,
+        'rejected': 0,
+        'reasons': {},
+        'sample': [],
+        'parse_time': None,
+        'loaded_at': None,
+    }
 
+
+def get_snapshot():
+    """Returns snapshot published by background loader or None when data
+    is loaded on demand. While loader is starting, the first call waits up
+    to 'LOADER_TIMEOUT' seconds for its first load. If it failed or took
+    longer, data is loaded on demand until a snapshot is published.
+    """
+    loader = SNAPSHOT['loader']
+    if loader is not None and SNAPSHOT['current'] is None:
+        if not loader.waited:
+            loader.attempted.wait(app.config.get('LOADER_TIMEOUT', 30))
+            loader.waited = True
+    return SNAPSHOT['current']
+
+
+def iter_presence_rows(path, report=None):
+    """Yields (user_id, date, start, end) tuples parsed from presence CSV."""
+    with open(path, 'r') as csvfile:
+        for row in parse_presence_rows(csvfile, report):
+            yield row
+
+
+def parse_presence_rows(lines, report=None):
+    """Yields (user_id, date, start, end) tuples parsed from CSV lines.
+
+    Rows which can't be parsed (including header and footer lines) are
+    skipped and, if report is given, counted in it by reason.
+    """
+    presence_reader = csv.reader(lines, delimiter=',')
+    for row in presence_reader:
+        if len(row) != 4:
+            reason = 'columns'
+        else:
             try:
+                reason = 'user_id'
                 user_id = int(row[0])
+                reason = 'date'
                 date = datetime.strptime(row[1], '%Y-%m-%d').date()
+                reason = 'start'
                 start = datetime.strptime(row[2], '%H:%M:%S').time()
+                reason = 'end'
                 end = datetime.strptime(row[3], '%H:%M:%S').time()
+                reason = None
             except (ValueError, TypeError):
-                log.debug('Problem with line %d: ', i, exc_info=True)
+                pass
+
+        if reason is None:
+            if report is not None:
+                report['rows'] += 1
+            yield user_id, date, start, end
+        elif report is not None:
+            report['rejected'] += 1
+            report['reasons'][reason] = report['reasons'].get(reason, 0) + 1
+            if len(report['sample']) < REJECTED_SAMPLE:
+                report['sample'].append([presence_reader.line_num, reason])
+
+
+def iter_user_rows(data, user_id=None, since=None, until=None):
+    """Yields (user_id, date, start, end) tuples of loaded data ordered by
+    user and date, optionally limited to one user and a range of dates.
+    """
+    user_ids = [user_id] if user_id is not None else sorted(data)
+    for user in user_ids:
+        items = data.get(user, {})
+        for date in sorted(items):
+            if since is not None and date < since:
+                continue
+            if until is not None and date > until:
+                continue
+            yield user, date, items[date]['start'], items[date]['end']
 
-            data.setdefault(user_id, {})[date] = {'start': start, 'end': end}
 
-    return data
+def csv_row(row):
+    """Formats presence row like lines of DATA_CSV."""
+    return '{0},{1},{2},{3}\n'.format(*row)
+
+
+def ndjson_row(row):
+    """Formats presence row as a line of JSON."""
+    user_id, date, start, end = row
+    return dumps({
+        'user_id': user_id,
+        'date': date.isoformat(),
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+    }) + '\n'
+
+
+def chunked(lines, size):
+    """Joins lines into chunks of given number of lines."""
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= size:
+            yield ''.join(chunk)
+            chunk = []
+    if chunk:
+        yield ''.join(chunk)
 
 
 def group_by_weekday(items):
@@ -125,6 +433,197 @@ def group_by_start_end(items):
     return result
 
 
+@cache_by_data("occupancy")
+def get_occupancy(data, since, until, resolution):
+    """Calculates mean number of people present by weekday.
+
+    Presence of each entry is added to per weekday difference arrays of
+    minutes (+1 at start, -1 at end), so a single running sum gives number
+    of people present in every minute. It's divided by the number of days
+    and the highest value of each 'resolution' minutes long bucket is
+    returned:
+    result = {
+        0: [0.0, 0.0, ..., 12.5, 14.0, ...],
+        ...
+    }
+    """
+    diffs = [[0] * (MINUTES_PER_DAY + 1) for _ in range(7)]
+    days = [set() for _ in range(7)]
+    for items in data.itervalues():
+        for date, times in items.iteritems():
+            if since is not None and date < since:
+                continue
+            if until is not None and date > until:
+                continue
+            start = seconds_since_midnight(times['start']) // 60
+            end = seconds_since_midnight(times['end']) // 60
+            if end <= start:
+                continue
+            weekday = date.weekday()
+            diffs[weekday][start] += 1
+            diffs[weekday][end] -= 1
+            days[weekday].add(date)
+
+    result = {}
+    for weekday in range(7):
+        present = 0
+        minutes = []
+        for change in diffs[weekday][:MINUTES_PER_DAY]:
+            present += change
+            minutes.append(present)
+        count = len(days[weekday])
+        result[weekday] = [
+            float(max(minutes[i:i + resolution])) / count if count else 0
+            for i in range(0, MINUTES_PER_DAY, resolution)
+        ]
+    return result
+
+
+@cache_by_data("histograms", 1)
+def get_histograms(data):
+    """Builds histograms of start, end and presence time of each user by
+    weekday, with buckets 'HISTOGRAM_RESOLUTION' seconds long (default 60).
+
+    It creates structure like this:
+    histograms = {
+        'resolution': 60,
+        'users': {
+            10: {
+                0: {
+                    'start': ([540, 541], [2, 3]),
+                    'end': ([1020], [3]),
+                    'presence': ([479, 480], [2, 3]),
+                },
+                ...
+            },
+        },
+    }
+    where histograms hold sorted bucket numbers and running totals of
+    entries in them (see cumulate).
+    """
+    resolution = app.config.get('HISTOGRAM_RESOLUTION', 60)
+    return {
+        'resolution': resolution,
+        'users': {
+            user_id: user_histograms(items, resolution)
+            for user_id, items in data.iteritems()
+        },
+    }
+
+
+def user_histograms(items, resolution):
+    """Builds histograms of start, end and presence time of entries of
+    a user by weekday, like get_histograms()['users'][user_id].
+    """
+    weekdays = {
+        i: {'start': {}, 'end': {}, 'presence': {}}
+        for i in range(7)
+    }
+    for date, times in items.iteritems():
+        start = seconds_since_midnight(times['start'])
+        end = seconds_since_midnight(times['end'])
+        histograms = weekdays[date.weekday()]
+        for name, value in (
+                ('start', start),
+                ('end', end),
+                ('presence', end - start)):
+            bucket = value // resolution
+            histogram = histograms[name]
+            histogram[bucket] = histogram.get(bucket, 0) + 1
+    return {
+        weekday: {
+            name: cumulate(histogram)
+            for name, histogram in histograms.iteritems()
+        }
+        for weekday, histograms in weekdays.iteritems()
+    }
+
+
+def cumulate(histogram):
+    """Turns histogram mapping bucket number to number of entries into
+    sorted bucket numbers and running totals of entries.
+    """
+    buckets = sorted(histogram)
+    totals = []
+    seen = 0
+    for bucket in buckets:
+        seen += histogram[bucket]
+        totals.append(seen)
+    return buckets, totals
+
+
+def histogram_percentile(histogram, percent, resolution):
+    """Returns start of the bucket holding given percentile of entries of
+    histogram made by cumulate (nearest rank). Returns zero for empty
+    histogram.
+    """
+    buckets, totals = histogram
+    if not totals:
+        return 0
+    rank = max(int(math.ceil(percent / 100.0 * totals[-1])), 1)
+    return buckets[bisect_left(totals, rank)] * resolution
+
+
+@cache_by_data("daily_presence")
+def get_daily_presence(data, user_id):
+    """Returns sorted dates of given user and presence time (in seconds)
+    of each of them as two lists. Returns None for unknown user.
+    """
+    if user_id not in data:
+        return None
+    return daily_presence(data[user_id])
+
+
+def daily_presence(items):
+    """Returns sorted dates of entries of a user and presence time (in
+    seconds) of each of them as two lists.
+    """
+    dates = sorted(items)
+    return dates, [
+        interval(items[date]['start'], items[date]['end'])
+        for date in dates
+    ]
+
+
+TIMELINE_BUCKETS = {
+    'day': lambda date: date,
+    'week': lambda date: date - timedelta(days=date.weekday()),
+    'month': lambda date: date.replace(day=1),
+}
+
+
+def choose_bucket(since, until, max_points):
+    """Returns the finest bucket giving at most 'max_points' buckets in
+    given range of dates.
+    """
+    days = (until - since).days + 1
+    if days <= max_points:
+        return 'day'
+    if days // 7 + 1 <= max_points:
+        return 'week'
+    return 'month'
+
+
+def downsample(dates, values, since, until, bucket):
+    """Groups values of sorted dates within given range into buckets.
+
+    Returns list of (bucket start, sum, count) tuples for buckets having
+    any entries.
+    """
+    bucket_start = TIMELINE_BUCKETS[bucket]
+    first = bisect_left(dates, since)
+    last = bisect_right(dates, until)
+    result = []
+    for date, value in zip(dates[first:last], values[first:last]):
+        key = bucket_start(date)
+        if result and result[-1][0] == key:
+            _, total, count = result[-1]
+            result[-1] = (key, total + value, count + 1)
+        else:
+            result.append((key, value, 1))
+    return result
+
+
 def seconds_since_midnight(time):
     """Calculates amount of seconds since midnight."""
     return time.hour * 3600 + time.minute * 60 + time.second
@@ -142,31 +641,116 @@ def mean(items):
     return float(sum(items)) / len(items) if len(items) > 0 else 0
 
 
+def average(total, count):
+    """Calculates arithmetic mean from sum and number of items. Returns
+    zero when there are no items.
+    """
+    return float(total) / count if count > 0 else 0
+
+
 def get_users_data():
     """Returns users data. Their id, name and avatar address."""
-    with open(app.config['DATA_XML'], 'r') as xmlfile:
-        data = etree.parse(xmlfile)
-    root = data.getroot()
-    config = root[0]
-    server = {
-        u'protocol': unicode(config.findtext(u'protocol')),
-        u'host': unicode(config.findtext('host'))
-    }
-    address = '{0}://{1}'.format(server['protocol'], server[u'host'])
-    return {
-        user.get('id'): {
-            u'name': user.findtext(u'name'),
-            u'avatar': '{0}{1}'.format(address, user.findtext(u'avatar'))
+    snapshot = get_snapshot()
+    if snapshot is not None:
+        return snapshot.users
+    return load_users_data()
+
+
+@locker
+@cache("get_users_data", 600)
+def load_users_data():
+    """Loads users data on demand."""
+    return parse_users_data(app.config['DATA_XML'])
+
+
+@cache_by_data("sorted_users", 1, get_users_data)
+def get_sorted_users(users):
+    """Returns users listing sorted by name. Avatars point to local
+    copies when 'AVATAR_DIR' is set.
+    """
+    setup_locale()
+    local = bool(app.config.get('AVATAR_DIR'))
+    result = [
+        {
+            'user_id': user,
+            'name': user_data['name'],
+            'avatar': url_for('avatar_view', user_id=user) if local
+            else user_data['avatar']
         }
-        for user in root[1]
-    }
+        for user, user_data in users.iteritems()
+    ]
+    return sorted(result, key=lambda k: k['name'], cmp=locale.strcoll)
+
+
+def render_page(template_name):
+    """Returns body and ETag of page rendered from given template.
+
+    Pages depend only on users listing embedded in them, so each is
+    rendered once per users data (on every request in debug mode).
+    """
+    users = get_sorted_users()
+    page = PAGES.get(template_name)
+    if page is None or page['users'] is not users or app.debug:
+        bootstrap = dumps({'users': users}).replace('</', '<\\/')
+        body = render_template(template_name, bootstrap=bootstrap)
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        page = PAGES[template_name] = {
+            'users': users,
+            'body': body,
+            'etag': md5(body).hexdigest(),
+        }
+    return page['body'], page['etag']
 
 
-def update_xml():
-    """Update the server"""
-    from urllib import urlretrieve
+def static_fingerprint(filename):
+    """Returns hash of content of given static file or None if there's no
+    such file in static folder. Only hashes of existing files are kept.
+    """
+    filename = posixpath.normpath(filename)
+    fingerprint = STATIC_FINGERPRINTS.get(filename)
+    if fingerprint is None or app.debug:
+        try:
+            path = safe_join(app.static_folder, filename)
+            with open(path, 'rb') as fp:
+                fingerprint = md5(fp.read()).hexdigest()[:12]
+        except (NotFound, IOError):
+            STATIC_FINGERPRINTS.pop(filename, None)
+            return None
+        STATIC_FINGERPRINTS[filename] = fingerprint
+    return fingerprint
+
+
+def setup_locale():
+    """Sets collation used to sort users' names. It's done once, on first
+    use, as setlocale affects the whole process.
+    """
+    if not LOCALE['collate']:
+        locale.setlocale(locale.LC_COLLATE, 'pl_PL.utf-8')
+        LOCALE['collate'] = True
+
+
+def avatar_path(user_id):
+    """Returns path of local copy of user's avatar."""
+    return os.path.join(app.config['AVATAR_DIR'], str(user_id))
+
+
+def refresh_avatars(missing_only=False, users=None):
+    """Stores thumbnails of avatars of given (by default current) users
+    in 'AVATAR_DIR'.
+    """
+    if users is None:
+        users = get_users_data()
+    return store_avatars(users, app.config, missing_only)
+
 
-    return urlretrieve(
-        app.config['DATA_SERVER_ADDRESS'],
-        app.config['DATA_XML']
+def start_avatar_refresh():
+    """Fetches missing avatars in background thread."""
+    worker = threading.Thread(
+        target=refresh_avatars,
+        kwargs={'missing_only': True},
+        name='presence-avatars',
     )
+    worker.daemon = True
+    worker.start()
+    return worker
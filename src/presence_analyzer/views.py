@@ -1,24 +1,48 @@
 # -*- coding: utf-8 -*-
 """Defines views."""
 
+import os
+import imghdr
 import calendar
-import locale
+from datetime import datetime
+from json import dumps
 from flask import (
+    abort,
     url_for,
     redirect,
+    request,
+    Response,
 )
-from flask.ext.mako import render_template
 from mako.exceptions import TopLevelLookupException
 
 from presence_analyzer.main import app
 from presence_analyzer.utils import (
     jsonify,
-    get_data,
-    mean,
-    group_by_weekday,
-    group_by_start_end,
+    avatar_path,
+    average,
+    chunked,
+    choose_bucket,
+    csv_row,
+    downsample,
+    ndjson_row,
+    get_occupancy,
+    get_sorted_users,
     get_users_data,
+    histogram_percentile,
+    INGESTION,
+    render_page,
+    static_fingerprint,
+    MINUTES_PER_DAY,
+    TIMELINE_BUCKETS,
 )
+from presence_analyzer.storage import (
+    get_user_histograms,
+    get_user_timeline,
+    get_weekday_stats,
+    iter_rows,
+    prepare,
+)
+from presence_analyzer.warmup import readiness
 
 import logging
 log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
@@ -29,7 +53,16 @@ TEMPLATE_LIST = (
     'presence_start_end.html'
 )
 
-locale.setlocale(locale.LC_COLLATE, 'pl_PL.utf-8')
+PERCENTILES = (
+    (10, 'p10'),
+    (50, 'median'),
+    (90, 'p90'),
+)
+
+EXPORT_FORMATS = {
+    'csv': ('text/csv', csv_row),
+    'ndjson': ('application/x-ndjson', ndjson_row),
+}
 
 
 @app.route('/')
@@ -40,36 +73,50 @@ def mainpage():
     )
 
 
+@app.route('/healthz', methods=['GET'])
+@jsonify
+def healthz_view():
+    """Reports the worker is alive."""
+    return {'status': 'ok'}
+
+
+@app.route('/readyz', methods=['GET'])
+def readyz_view():
+    """Reports whether the worker is warmed up and has data loaded."""
+    result = readiness()
+    return Response(dumps(result), status=200 if result['ready'] else 503,
+                    mimetype='application/json')
+
+
+@app.route('/api/v1/ingestion', methods=['GET'])
+@jsonify
+def ingestion_view():
+    """Returns report of the last load of presence data by current storage
+    backend.
+    """
+    prepare()
+    return INGESTION['report']
+
+
 @app.route('/api/v1/users', methods=['GET'])
 @jsonify
 def users_view():
     """Users listing for dropdown."""
-    data = get_users_data()
-    result = [
-        {
-            'user_id': user,
-            'name': user_data['name'],
-            'avatar': user_data['avatar']
-        }
-        for user, user_data in data.iteritems()
-    ]
-
-    result = sorted(result, key=lambda k: k['name'], cmp=locale.strcoll)
-    return result
+    return get_sorted_users()
 
 
 @app.route('/api/v1/mean_time_weekday/<int:user_id>', methods=['GET'])
 @jsonify
 def mean_time_weekday_view(user_id):
     """Returns mean presence time of given user grouped by weekday."""
-    data = get_data()
-    if user_id not in data:
+    weekdays = get_weekday_stats(user_id)
+    if weekdays is None:
         log.debug('User {0} not found!'.format(user_id))
         return []
 
-    weekdays = group_by_weekday(data[user_id])
-    result = [(calendar.day_abbr[weekday], mean(intervals))
-              for weekday, intervals in weekdays.items()]
+    result = [(calendar.day_abbr[weekday],
+               average(stats['presence'], stats['count']))
+              for weekday, stats in weekdays.items()]
     return result
 
 
@@ -77,14 +124,13 @@ def mean_time_weekday_view(user_id):
 @jsonify
 def presence_weekday_view(user_id):
     """Returns total presence time of given user grouped by weekday."""
-    data = get_data()
-    if user_id not in data:
+    weekdays = get_weekday_stats(user_id)
+    if weekdays is None:
         log.debug('User {0} not found!'.format(user_id))
         return []
 
-    weekdays = group_by_weekday(data[user_id])
-    result = [(calendar.day_abbr[weekday], sum(intervals))
-              for weekday, intervals in weekdays.items()]
+    result = [(calendar.day_abbr[weekday], stats['presence'])
+              for weekday, stats in weekdays.items()]
     result.insert(0, ('Weekday', 'Presence (s)'))
 
     return result
@@ -94,26 +140,258 @@ def presence_weekday_view(user_id):
 @jsonify
 def presence_start_end_view(user_id):
     """Returns mean start and end time of given user"""
-    data = get_data()
-    if user_id not in data:
+    weekdays = get_weekday_stats(user_id)
+    if weekdays is None:
         log.debug('User {0} not found!'.format(user_id))
         return []
 
-    weekdays = group_by_start_end(data[user_id])
     result = [
-        (calendar.day_abbr[weekday], mean(times['start']), mean(times['end']))
-        for weekday, times in weekdays.items()]
+        (calendar.day_abbr[weekday],
+         average(stats['start'], stats['count']),
+         average(stats['end'], stats['count']))
+        for weekday, stats in weekdays.items()]
 
     return result
 
 
+@app.route('/api/v1/presence_percentiles/<int:user_id>', methods=['GET'])
+@jsonify
+def presence_percentiles_view(user_id):
+    """Returns p10, median and p90 of start, end and presence time of given
+    user grouped by weekday.
+    """
+    histograms = get_user_histograms(user_id)
+    if histograms is None:
+        log.debug('User {0} not found!'.format(user_id))
+        return []
+
+    resolution, user_weekdays = histograms
+    names = ('start', 'end', 'presence')
+    result = [
+        [calendar.day_abbr[weekday]] + [
+            histogram_percentile(weekdays[name], percent, resolution)
+            for name in names
+            for percent, _ in PERCENTILES
+        ]
+        for weekday, weekdays in user_weekdays.items()
+    ]
+    result.insert(0, ['Weekday'] + [
+        '{0} {1}'.format(name.capitalize(), label)
+        for name in names
+        for _, label in PERCENTILES
+    ])
+    return result
+
+
+@app.route('/api/v1/timeline/<int:user_id>', methods=['GET'])
+@jsonify
+def timeline_view(user_id):
+    """Returns presence time of given user over time.
+
+    Dates can be limited with 'since' and 'until' (YYYY-MM-DD). Entries
+    are grouped by 'bucket' ('day', 'week' or 'month'), by default the
+    finest one giving at most 'TIMELINE_MAX_POINTS' rows. Each row holds
+    bucket start, total and mean presence time and number of days.
+    """
+    daily = get_user_timeline(user_id)
+    if daily is None:
+        log.debug('User {0} not found!'.format(user_id))
+        return []
+
+    dates, values = daily
+    since = date_arg('since') or dates[0]
+    until = date_arg('until') or dates[-1]
+    bucket = request.args.get('bucket') or choose_bucket(
+        since, until, app.config.get('TIMELINE_MAX_POINTS', 500)
+    )
+    if bucket not in TIMELINE_BUCKETS:
+        abort(400)
+
+    result = [
+        (start.isoformat(), total, average(total, count), count)
+        for start, total, count in downsample(
+            dates, values, since, until, bucket
+        )
+    ]
+    result.insert(0, ('Date', 'Presence (s)', 'Mean (s)', 'Days'))
+    return result
+
+
+BOOTSTRAP_STATS = {
+    'mean_time_weekday': mean_time_weekday_view,
+    'presence_weekday': presence_weekday_view,
+    'presence_start_end': presence_start_end_view,
+    'presence_percentiles': presence_percentiles_view,
+}
+
+
+@app.route('/api/v1/bootstrap', methods=['GET'])
+@jsonify
+def bootstrap_view():
+    """Returns data needed to show a page in one response.
+
+    Holds users listing and, when 'user_id' is given, statistics of the
+    user named in comma separated 'stats' (all by default), as returned
+    by their own endpoints.
+    """
+    result = {'users': get_sorted_users()}
+    user_id = int_arg('user_id')
+    if user_id is None:
+        return result
+
+    names = request.args.get('stats')
+    names = names.split(',') if names else sorted(BOOTSTRAP_STATS)
+    if not set(names) <= set(BOOTSTRAP_STATS):
+        abort(400)
+    result['user_id'] = user_id
+    result['stats'] = {
+        name: BOOTSTRAP_STATS[name].__wrapped__(user_id)
+        for name in names
+    }
+    return result
+
+
+@app.route('/api/v1/export/<export_format>', methods=['GET'])
+def export_view(export_format):
+    """Streams raw presence rows as CSV or NDJSON.
+
+    Rows can be limited with 'user_id', 'since' and 'until' (YYYY-MM-DD)
+    query parameters.
+    """
+    if export_format not in EXPORT_FORMATS:
+        return "404", 404
+    user_id = int_arg('user_id')
+    since = date_arg('since')
+    until = date_arg('until')
+
+    mimetype, format_row = EXPORT_FORMATS[export_format]
+    rows = iter_rows(user_id, since, until)
+    chunks = chunked(
+        (format_row(row) for row in rows),
+        app.config.get('EXPORT_CHUNK_ROWS', 1000)
+    )
+    return Response(chunks, mimetype=mimetype, headers={
+        'Content-Disposition':
+            'attachment; filename=presence.{0}'.format(export_format),
+    })
+
+
+@app.route('/api/v1/occupancy', methods=['GET'])
+@jsonify
+def occupancy_view():
+    """Returns mean number of people present in the office by weekday.
+
+    Each row holds bucket start time and a value for each weekday: the
+    highest mean number of people present in a minute of the bucket. Dates
+    can be limited with 'since' and 'until' (YYYY-MM-DD), bucket length
+    in minutes is set by 'resolution' (default 15). It needs all presence
+    data, so it's available only with 'memory' storage.
+    """
+    if app.config.get('STORAGE', 'memory') != 'memory':
+        abort(501, 'Occupancy is available only with memory storage')
+    since = date_arg('since')
+    until = date_arg('until')
+    resolution = int_arg('resolution', 15)
+    if not 0 < resolution <= MINUTES_PER_DAY:
+        abort(400)
+
+    weekdays = get_occupancy(since, until, resolution)
+    result = [
+        ['{0:02d}:{1:02d}'.format(*divmod(minute, 60))] +
+        [weekdays[weekday][i] for weekday in range(7)]
+        for i, minute in enumerate(range(0, MINUTES_PER_DAY, resolution))
+    ]
+    result.insert(0, ['Time'] + list(calendar.day_abbr))
+    return result
+
+
+def date_arg(name):
+    """Returns date passed in given query parameter as YYYY-MM-DD or None.
+    Aborts with 400 on wrong value.
+    """
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        abort(400)
+
+
+def int_arg(name, default=None):
+    """Returns integer passed in given query parameter or default. Aborts
+    with 400 on wrong value.
+    """
+    value = request.args.get(name)
+    if not value:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        abort(400)
+
+
+@app.route('/avatars/<int:user_id>', methods=['GET'])
+def avatar_view(user_id):
+    """Serves local copy of user's avatar. Redirects to the original one
+    if it isn't stored yet or avatars aren't stored at all.
+    """
+    path = avatar_path(user_id) if app.config.get('AVATAR_DIR') else None
+    if path is None or not os.path.exists(path):
+        user_data = get_users_data().get(str(user_id))
+        if user_data is None:
+            abort(404)
+        return redirect(user_data['avatar'])
+
+    with open(path, 'rb') as avatar_file:
+        content = avatar_file.read()
+    kind = imghdr.what(None, content) or 'png'
+    response = Response(content, mimetype='image/{0}'.format(kind))
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config.get(
+        'AVATAR_MAX_AGE', 7 * 24 * 3600
+    )
+    return response
+
+
 @app.route('/<template_name>', methods=['GET'])
 def template_render(template_name):
     """Create HTML document from template"""
     try:
         if template_name in TEMPLATE_LIST:
-            return render_template(template_name)
+            body, etag = render_page(template_name)
         else:
             raise TopLevelLookupException
     except TopLevelLookupException:
         return "404", 404
+
+    response = Response(body, mimetype='text/html')
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+@app.url_defaults
+def static_url_defaults(endpoint, values):
+    """Adds content hash of static files to their URLs."""
+    if endpoint == 'static' and 'filename' in values:
+        fingerprint = static_fingerprint(values['filename'])
+        if fingerprint is not None:
+            values.setdefault('v', fingerprint)
+
+
+@app.after_request
+def static_cache_headers(response):
+    """Lets browsers keep static files requested with current content hash
+    for 'STATIC_MAX_AGE' seconds.
+    """
+    if request.endpoint != 'static' or not request.args.get('v'):
+        return response
+    if response.status_code != 200:
+        return response
+    if request.args['v'] == static_fingerprint(request.view_args['filename']):
+        response.cache_control.public = True
+        response.cache_control.max_age = app.config.get(
+            'STATIC_MAX_AGE', 365 * 24 * 3600
+        )
+    return response
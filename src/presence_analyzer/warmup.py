@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""Warm-up and readiness of application workers."""
+
+import threading
+from datetime import datetime
+
+from presence_analyzer.main import app
+from presence_analyzer import storage
+from presence_analyzer.utils import (
+    SNAPSHOT,
+    get_histograms,
+    get_users_data,
+    render_page,
+    setup_locale,
+)
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+WARMUP = {'thread': None, 'warmed_at': None, 'error': None}
+
+
+def warm_up(templates):
+    """Sets locale, preloads data, builds storage structures and renders
+    pages. Histograms are built only for 'memory' storage, as they need
+    all presence data. Failure is logged and reported by readiness().
+    """
+    started = datetime.now()
+    try:
+        setup_locale()
+        get_users_data()
+        storage.prepare()
+        if app.config.get('STORAGE', 'memory') == 'memory':
+            get_histograms()
+        with app.test_request_context():
+            for template_name in templates:
+                render_page(template_name)
+    except Exception as error:  # pylint: disable-msg=W0703
+        log.exception('Warm-up failed')
+        WARMUP['error'] = '{0}: {1}'.format(type(error).__name__, error)
+        return
+    WARMUP['warmed_at'] = datetime.now()
+    log.info('Warmed up in %s', WARMUP['warmed_at'] - started)
+
+
+def start_warm_up(templates):
+    """Runs warm-up in background thread, so readiness can be reported
+    meanwhile.
+    """
+    if WARMUP['thread'] is None:
+        thread = threading.Thread(
+            target=warm_up,
+            args=(templates,),
+            name='presence-warmup',
+        )
+        thread.daemon = True
+        WARMUP['thread'] = thread
+        thread.start()
+    return WARMUP['thread']
+
+
+def readiness():
+    """Returns readiness of the worker.
+
+    Worker is ready when warm-up (if started) finished and background
+    loader (if running) published data. Error of failed warm-up is
+    reported in 'warmup_error'.
+    """
+    snapshot = SNAPSHOT['current']
+    warming_up = WARMUP['thread'] is not None and WARMUP['warmed_at'] is None
+    loading = SNAPSHOT['loader'] is not None and snapshot is None
+    return {
+        'ready': not (warming_up or loading),
+        'generation': snapshot.generation if snapshot else None,
+        'loaded_at': snapshot.loaded_at.isoformat() if snapshot else None,
+        'warmed_at': (
+            WARMUP['warmed_at'].isoformat() if WARMUP['warmed_at'] else None
+        ),
+        'warmup_error': WARMUP['error'],
+    }